@@ -0,0 +1,255 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import statistics
+import subprocess
+import collections
+
+import stub_server
+
+
+def _percentiles(latencies: list) -> dict:
+    if len(latencies) < 2:
+        return {"p50": None, "p95": None, "p99": None}
+    q = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {"p50": q[49], "p95": q[94], "p99": q[98]}
+
+
+def _time_checks(latencies: list):
+    """
+    Record the duration of every check, including those made by the bulk APIs,
+    so the latency is measured the same way in all modes.
+    """
+    import weboptout.web
+
+    check = weboptout.web.check_domain_reservation
+
+    async def _timed(*args, **kwargs):
+        started = time.monotonic()
+        try:
+            return await check(*args, **kwargs)
+        finally:
+            latencies.append(time.monotonic() - started)
+
+    weboptout.web.check_domain_reservation = _timed
+    return _timed
+
+
+async def _run_worker(mode: str, jobs: int, domains: list, port: int, urls_per_host: int, results: str = None) -> dict:
+    from weboptout import rsv
+    from weboptout.bulk import check_sources_in_bulk, check_urls_in_bulk, reservation_to_dict
+
+    connector = stub_server.create_connector(port, limit=jobs * 2)
+    counts, latencies = collections.Counter(), []
+    check_domain_reservation = _time_checks(latencies)
+    started = time.monotonic()
+
+    if mode == "direct":
+        semaphore = asyncio.Semaphore(jobs)
+
+        async def _check(domain):
+            async with semaphore:
+                res = await check_domain_reservation(domain, retention="none", connector=connector)
+                counts[rsv.get_name(res)] += 1
+
+        await asyncio.gather(*[_check(d) for d in domains])
+
+    elif mode == "bulk":
+        output = open(results, "w") if results else None
+        async for source, res in check_sources_in_bulk(domains, jobs=jobs, retention="none", connector=connector):
+            counts[rsv.get_name(res)] += 1
+            if output:
+                output.write(json.dumps({"source": source, **reservation_to_dict(res)}) + "\n")
+        if output:
+            output.close()
+
+    elif mode == "urls":
+        urls = (f"https://{d}/images/{i}.jpg" for i in range(urls_per_host) for d in domains)
+        async for _, res in check_urls_in_bulk(urls, jobs=jobs, connector=connector):
+            counts[rsv.get_name(res)] += 1
+
+    elapsed = time.monotonic() - started
+    await connector.close()
+
+    checks = sum(counts.values())
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "mode": mode,
+        "jobs": jobs,
+        "checks": checks,
+        "elapsed": elapsed,
+        "checks_per_second": checks / elapsed,
+        **_percentiles(latencies),
+        "peak_rss_mb": rss / 1024 if sys.platform != "darwin" else rss / 1024 / 1024,
+        "results": dict(sorted(counts.items())),
+        # Only kept by sharded mode, to compute percentiles over all shards.
+        "latencies": latencies,
+    }
+
+
+def _worker_command(args, mode, jobs, port, *extra) -> list:
+    return [
+        sys.executable, os.path.abspath(__file__), "--worker",
+        "--mode", mode, "--jobs", str(jobs), "--port", str(port),
+        "--sites", str(args.sites), "--urls-per-host", str(args.urls_per_host), *extra,
+    ]
+
+
+def _run_scenario(args, mode, jobs, port, cache) -> dict:
+    """
+    Run one scenario in a fresh interpreter so peak memory and caches are isolated.
+    """
+    if mode == "sharded":
+        return _run_sharded(args, jobs, port, cache)
+
+    # Results of each source are written in bulk mode, to compare with sharded mode.
+    extra = ("--results", f"{cache}/results.jsonl") if mode == "bulk" else ()
+    output = subprocess.run(
+        _worker_command(args, mode, jobs, port, *extra),
+        env=dict(os.environ, WEBOPTOUT_CACHE=cache), check=True, capture_output=True, text=True,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    del result["latencies"]
+    return result
+
+
+def _run_sharded(args, jobs, port, cache) -> dict:
+    """
+    Run one process per shard with separate caches and results, then merge them.
+    The concurrency is split between shards, so the single stub server gets the
+    same load as in the other modes.
+    """
+    from weboptout.shards import merge_results
+
+    started, count = time.monotonic(), args.processes
+    workers = [
+        subprocess.Popen(
+            _worker_command(args, "bulk", max(1, jobs // count), port, "--shard", f"{i}/{count}", "--results", f"{cache}/shard-{i}.jsonl"),
+            env=dict(os.environ, WEBOPTOUT_CACHE=f"{cache}/shard-{i}"), stdout=subprocess.PIPE, text=True,
+        )
+        for i in range(count)
+    ]
+    shards = [json.loads(w.communicate()[0].strip().splitlines()[-1]) for w in workers]
+    elapsed = time.monotonic() - started
+
+    with open(f"{cache}/results.jsonl", "w") as output:
+        counts = merge_results([f"{cache}/shard-{i}.jsonl" for i in range(count)], output)
+
+    checks = sum(counts.values())
+    return {
+        "mode": "sharded",
+        "jobs": jobs,
+        "checks": checks,
+        "elapsed": elapsed,
+        "checks_per_second": checks / elapsed,
+        **_percentiles([t for s in shards for t in s["latencies"]]),
+        "peak_rss_mb": sum(s["peak_rss_mb"] for s in shards),
+        "results": dict(sorted(counts.items())),
+    }
+
+
+def _read_statuses(filename: str) -> dict:
+    with open(filename) as f:
+        return {(data := json.loads(line))["source"]: data["status"] for line in f if line.strip()}
+
+
+def _compare_statuses(reference: str, results: str) -> dict:
+    """
+    Sources that don't have the same status in both result files, which happens
+    when the machine is saturated and requests time out in one of the runs.
+    """
+    expected, actual = _read_statuses(reference), _read_statuses(results)
+    return {k: (expected.get(k), actual.get(k)) for k in sorted(expected.keys() | actual.keys()) if expected.get(k) != actual.get(k)}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def _print_comparison(results: list, previous: dict):
+    before = {(r["mode"], r["jobs"], r.get("cache")): r for r in previous["scenarios"]}
+    print(f"\nCompared to {previous.get('commit')}:\n")
+    for r in results:
+        if (old := before.get((r["mode"], r["jobs"], r.get("cache")))) is None:
+            continue
+        speedup = r["checks_per_second"] / old["checks_per_second"] - 1.0
+        p95 = (r["p95"] / old["p95"] - 1.0) if r["p95"] and old["p95"] else 0.0
+        print(f"  {r['mode']:8} jobs={r['jobs']:<4} {r['cache']:5}  checks/s {speedup:+7.1%}   p95 {p95:+7.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the checks against a local stub server.")
+    parser.add_argument("--sites", type=int, default=44, help="Number of synthetic domains to check.")
+    parser.add_argument("--jobs", default="8,32", help="Comma-separated levels of concurrency.")
+    parser.add_argument("--modes", default="direct,bulk,urls,sharded", help="Comma-separated APIs to benchmark.")
+    parser.add_argument("--processes", type=int, default=4, help="Number of shards in `sharded` mode.")
+    parser.add_argument("--stub-processes", type=int, default=min(4, os.cpu_count() or 1),
+                        help="Processes of the stub server, to keep it from being the bottleneck.")
+    parser.add_argument("--urls-per-host", type=int, default=20, help="URLs generated per domain in `urls` mode.")
+    parser.add_argument("--warm", action="store_true", help="Also run each scenario again with a warm cache.")
+    parser.add_argument("--output", default="bench_e2e.json", help="File to write the JSON results.")
+    parser.add_argument("--compare", default=None, help="Previous JSON results to compare against.")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--shard", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--results", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        domains = stub_server.make_domains(args.sites)
+        if args.shard is not None:
+            from weboptout.shards import select_shard
+            domains = list(select_shard(domains, *map(int, args.shard.split("/"))))
+        result = asyncio.run(_run_worker(args.mode, int(args.jobs), domains, args.port, args.urls_per_host, args.results))
+        print(json.dumps(result))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server, port = stub_server.start_in_subprocess(tmp, args.stub_processes)
+        results, outputs = [], {}
+        try:
+            print(f"{'Mode':8} {'Jobs':>5} {'Cache':>6} {'Checks/s':>9} {'p50':>8} {'p95':>8} {'p99':>8} {'RSS':>8}\n")
+            for mode in args.modes.split(","):
+                for jobs in map(int, args.jobs.split(",")):
+                    cache = tempfile.mkdtemp(dir=tmp)
+                    for state in ("cold", "warm") if args.warm else ("cold",):
+                        r = dict(_run_scenario(args, mode, jobs, port, cache), cache=state)
+                        results.append(r)
+                        if mode in ("bulk", "sharded"):
+                            outputs[mode, jobs, state] = f"{cache}/results.jsonl"
+                        if mode == "sharded" and ("bulk", jobs, state) in outputs:
+                            r["differences"] = _compare_statuses(outputs["bulk", jobs, state], outputs[mode, jobs, state])
+                        print(
+                            f"{mode:8} {jobs:5} {state:>6} {r['checks_per_second']:9.2f}",
+                            *(f"{r[p]*1000:6.0f}ms" if r[p] is not None else f"{'-':>8}" for p in ("p50", "p95", "p99")),
+                            f"{r['peak_rss_mb']:6.0f}MB",
+                        )
+        finally:
+            server.terminate()
+
+    report = {"commit": _git_commit(), "python": sys.version, "sites": args.sites, "scenarios": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            _print_comparison(results, json.load(f))
+
+    # Checked after the report is written, so the measurements are still available.
+    different = {(r["jobs"], r["cache"]): r["differences"] for r in results if r.get("differences")}
+    assert not different, f"Statuses in sharded mode differ from bulk mode, try fewer --jobs: {different}"
+
+
+if __name__ == "__main__":
+    main()
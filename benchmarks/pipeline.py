@@ -0,0 +1,185 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import os
+import json
+import glob
+import time
+import pstats
+import asyncio
+import cProfile
+import hashlib
+import argparse
+import warnings
+import collections
+
+import langdetect
+from bs4 import BeautifulSoup
+from langdetect.lang_detect_exception import LangDetectException
+
+from weboptout.client import ClientSession
+from weboptout.config import RE_TDM_CONCEPTS, RE_NFP_CONCEPTS
+from weboptout.http import _find_tos_links_from_html
+from weboptout.html import check_tos_reservation, classify_texts, _extract_paragraphs, _find_matching_paragraphs
+
+import synthetic
+
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+EXPECTED_FILE = os.path.join(CORPUS_DIR, "expected.json")
+
+
+def load_corpus(seed: int, count: int) -> dict:
+    """
+    Pages stored in the corpus directory, which were generated by `synthetic.py`
+    and are kept fixed between commits, followed by freshly generated pages.
+    """
+    pages = {}
+    for filename in sorted(glob.glob(os.path.join(CORPUS_DIR, "*.html"))):
+        with open(filename, "r", encoding="utf-8") as f:
+            pages[os.path.basename(filename)] = f.read()
+    pages.update({f"synthetic/{k}": v for k, v in synthetic.corpus(seed=seed, count=count).items()})
+    return pages
+
+
+def _parse(html):
+    with warnings.catch_warnings(record=True):
+        return BeautifulSoup(html, "html.parser")
+
+
+async def _run_stages(client, name, html, timings, outcomes, texts):
+    url = f"https://{name.replace('/', '-')}.test/"
+
+    def timed(stage, fn, *args):
+        started = time.perf_counter()
+        result = fn(*args)
+        timings[stage].append(time.perf_counter() - started)
+        return result
+
+    client._steps, client._output = [], []
+    started = time.perf_counter()
+    _, links = await _find_tos_links_from_html(client, url, html)
+    timings["find_tos_links_from_html"].append(time.perf_counter() - started)
+
+    soup = timed("parse_html", _parse, html)
+    text = timed("extract_paragraphs", lambda s: "\n".join(_extract_paragraphs(s)), soup)
+    # Both sets of patterns are one stage, so it's timed once per page.
+    tdm, nfp = timed("find_matching_paragraphs", lambda t: (
+        _find_matching_paragraphs(RE_TDM_CONCEPTS, t), _find_matching_paragraphs(RE_NFP_CONCEPTS, t)
+    ), text)
+    lang = timed("detect_language", lambda t: langdetect.detect(t) if t.strip() else None, text)
+    texts[name] = (text, tdm, nfp)
+
+    client._steps, client._output = [], []
+    try:
+        status = timed("check_tos_reservation", check_tos_reservation, client, url, html)
+    except (AssertionError, LangDetectException):
+        status = None
+
+    outcomes[name] = {
+        # Links of equal length come from a set so their order isn't stable.
+        "links": sorted(links or []),
+        "paragraphs": text.count("\n") + 1,
+        "tdm": tdm[:1],
+        "nfp": nfp[:1],
+        "lang": lang,
+        "status": getattr(status, "name", None),
+        "output": client._output,
+    }
+
+
+def _fingerprint(outcome: dict) -> str:
+    return hashlib.sha1(json.dumps(outcome, sort_keys=True, default=str).encode()).hexdigest()
+
+
+async def run(pages: dict, repeat: int):
+    timings, outcomes = collections.defaultdict(list), {}
+    async with ClientSession() as client:
+        for _ in range(repeat):
+            texts = {}
+            for name, html in pages.items():
+                await _run_stages(client, name, html, timings, outcomes, texts)
+
+            # Classify all texts at once, with the time spread evenly across pages.
+            started = time.perf_counter()
+            classified = classify_texts([t for t, _, _ in texts.values()])
+            elapsed = time.perf_counter() - started
+            timings["classify_texts_batch"].extend([elapsed / len(texts)] * len(texts))
+
+            for (text, tdm, nfp), result in zip(texts.values(), classified):
+                assert (result.tdm, result.nfp) == (tdm, nfp), "Batch classification differs."
+    return timings, outcomes
+
+
+def _check_outcomes(outcomes: dict, update: bool) -> bool:
+    fingerprints = {name: _fingerprint(o) for name, o in outcomes.items()}
+    if update:
+        with open(EXPECTED_FILE, "w") as f:
+            json.dump(fingerprints, f, indent=2, sort_keys=True)
+        print(f"\nUpdated {len(fingerprints)} expected outcomes.")
+        return True
+
+    if not os.path.isfile(EXPECTED_FILE):
+        print("\nNo expected outcomes stored yet, run with --update-expected.")
+        return True
+
+    with open(EXPECTED_FILE) as f:
+        expected = json.load(f)
+    changed = [n for n, fp in fingerprints.items() if n in expected and expected[n] != fp]
+    for name in changed:
+        print(f"  CHANGED {name}: {json.dumps(outcomes[name], default=str)[:160]}")
+    print(f"\nOutcomes: {len(fingerprints) - len(changed)} unchanged, {len(changed)} changed.")
+    return len(changed) == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the HTML parsing and text classification.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic pages.")
+    parser.add_argument("--count", type=int, default=24, help="Number of synthetic pages to generate.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of passes over the corpus.")
+    parser.add_argument("--profile", default=None, help="Write cProfile statistics to this file.")
+    parser.add_argument("--output", default=None, help="Write the timings as JSON to this file.")
+    parser.add_argument("--update-expected", action="store_true", help="Store outcomes as the new reference.")
+    parser.add_argument("--generate-corpus", type=int, default=0, metavar="N", help="Store N generated pages in the corpus.")
+    args = parser.parse_args()
+
+    # Language detection is randomized unless seeded, which would make outcomes unstable.
+    langdetect.DetectorFactory.seed = 0
+
+    if args.generate_corpus > 0:
+        for name, html in synthetic.corpus(seed=1234, count=args.generate_corpus).items():
+            if not name.startswith("large"):
+                with open(os.path.join(CORPUS_DIR, f"{name}.html"), "w", encoding="utf-8") as f:
+                    f.write(html)
+        return
+
+    pages = load_corpus(args.seed, args.count)
+    total_bytes = sum(len(html) for html in pages.values())
+    print(f"Corpus of {len(pages)} synthetic pages, {total_bytes / 1e6:.1f}MB, {args.repeat} passes.\n")
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    timings, outcomes = asyncio.run(run(pages, args.repeat))
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+
+    print(f"{'Stage':28} {'total':>9} {'per page':>10} {'MB/s':>8}\n")
+    report = {}
+    for stage, values in timings.items():
+        total = sum(values)
+        per_page = total / len(values)
+        throughput = total_bytes * args.repeat / total / 1e6 if total > 0 else 0.0
+        report[stage] = {"total": total, "per_page": per_page, "calls": len(values)}
+        print(f"{stage:28} {total:8.3f}s {per_page*1000:8.2f}ms {throughput:8.2f}")
+
+    ok = _check_outcomes(outcomes, args.update_expected)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"corpus": "synthetic", "pages": len(pages), "stages": report, "outcomes_unchanged": ok}, f, indent=2)
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
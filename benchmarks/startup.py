@@ -0,0 +1,71 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+
+STATEMENTS = {
+    "import weboptout": "import weboptout",
+    "import weboptout.web": "import weboptout.web",
+    "from weboptout import check_domain_reservation": "from weboptout import check_domain_reservation",
+    "weboptout --help": "import sys; sys.argv = ['weboptout', '--help']; from weboptout.__main__ import main; main()",
+}
+
+
+def _time_statement(statement, repeat):
+    """
+    Measure the wall-clock time of a fresh interpreter running the statement, which
+    includes interpreter startup so it's comparable to real CLI invocations.
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def _slowest_imports(statement, count):
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    ).stderr
+
+    imports = []
+    for ln in output.splitlines()[1:]:
+        _, cumulative, name = [p.strip() for p in ln.replace("import time:", "").split("|")]
+        imports.append((int(cumulative), name))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of the library and CLI.")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--json", dest="output", default=None, help="Write the results to this file.")
+    args = parser.parse_args()
+
+    baseline = statistics.median(_time_statement("pass", args.repeat))
+    print(f"{'Statement':48} {'median':>9} {'min':>9} {'overhead':>9}\n")
+
+    results = {"python": sys.version, "interpreter": baseline, "statements": {}}
+    for label, statement in STATEMENTS.items():
+        timings = _time_statement(statement, args.repeat)
+        median = statistics.median(timings)
+        results["statements"][label] = {"median": median, "min": min(timings), "overhead": median - baseline}
+        print(f"{label:48} {median*1000:7.1f}ms {min(timings)*1000:7.1f}ms {(median-baseline)*1000:7.1f}ms")
+
+    print("\nSlowest imports for `import weboptout`:\n")
+    for cumulative, name in _slowest_imports(STATEMENTS["import weboptout"], count=8):
+        print(f"  {cumulative/1000:7.1f}ms  {name}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
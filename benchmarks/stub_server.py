@@ -0,0 +1,173 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import os
+import ssl
+import sys
+import zlib
+import random
+import socket
+import asyncio
+import argparse
+import functools
+import subprocess
+
+import aiohttp
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+
+import synthetic
+
+
+# Kinds of synthetic sites, each served under hostnames like `tos-3.test`.
+SITE_KINDS = ["tos", "nfp", "plain", "sub", "redirect", "slow", "timeout", "large", "fr", "nolinks", "dead"]
+
+
+def make_domains(count: int, kinds: list = SITE_KINDS) -> list:
+    """
+    List of `count` domains cycling through all kinds of sites, where subdomain
+    sites are requested with extra labels to exercise the fallback to parent domains.
+    """
+    domains = []
+    for i in range(count):
+        kind = kinds[i % len(kinds)]
+        domains.append(f"www.cdn.{kind}-{i}.test" if kind == "sub" else f"{kind}-{i}.test")
+    return domains
+
+
+@functools.lru_cache(maxsize=4096)
+def _render(host: str, path: str) -> str:
+    rng = random.Random(zlib.crc32(f"{host}{path}".encode()))
+    kind = host.split(".")[-2].split("-")[0]
+
+    if kind == "sub" and host.count(".") > 1:
+        return synthetic.landing_page(rng, footer=False)
+    if kind == "nolinks":
+        return synthetic.landing_page(rng, footer=False)
+    if kind == "large" and path == "/":
+        return synthetic.large_page(rng, size=2_000_000, links=[("/terms", "Terms of Service")])
+    if path == "/":
+        return synthetic.landing_page(rng, links=[("/terms", "Terms of Use")])
+    if path in ("/terms", "/legal"):
+        return synthetic.terms_page(
+            rng, paragraphs=rng.randint(30, 60), tdm=kind != "plain", nfp=kind == "nfp", lang="fr" if kind == "fr" else "en",
+        )
+    return None
+
+
+async def handle(request):
+    host, path = request.host.partition(":")[0], request.path
+    kind = host.split(".")[-2].split("-")[0] if host.count(".") > 0 else ""
+
+    if kind == "redirect" and path == "/":
+        raise web.HTTPMovedPermanently(f"https://{host.replace('redirect-', 'tos-')}/")
+    if kind == "slow":
+        await asyncio.sleep(1.5)
+    if kind == "timeout":
+        await asyncio.sleep(60.0)
+
+    if (html := _render(host, path)) is None:
+        raise web.HTTPNotFound()
+    return web.Response(text=html, content_type="text/html")
+
+
+class StubResolver(AbstractResolver):
+    """
+    Resolve all synthetic `.test` domains to the stub server, except dead ones.
+    """
+
+    def __init__(self, port: int):
+        self.port = port
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET):
+        if not host.endswith(".test") or host.split(".")[-2].startswith("dead-"):
+            raise socket.gaierror(socket.EAI_NONAME, f"Name or service not known: {host}")
+        return [{
+            "hostname": host, "host": "127.0.0.1", "port": self.port,
+            "family": socket.AF_INET, "proto": 0, "flags": socket.AI_NUMERICHOST,
+        }]
+
+    async def close(self):
+        pass
+
+
+def create_connector(port: int, limit: int = 100) -> aiohttp.TCPConnector:
+    """
+    Connector that routes requests to the stub server and accepts its certificate.
+    """
+    return aiohttp.TCPConnector(resolver=StubResolver(port), ssl=False, limit=limit)
+
+
+def _create_certificate(directory: str):
+    cert, key = os.path.join(directory, "stub.crt"), os.path.join(directory, "stub.key")
+    if not os.path.isfile(cert):
+        subprocess.run([
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "30",
+            "-subj", "/CN=stub.test", "-keyout", key, "-out", cert,
+        ], check=True, capture_output=True)
+    return cert, key
+
+
+async def serve(port: int, directory: str, reuse_port: bool = False):
+    cert, key = _create_certificate(directory)
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+
+    app = web.Application()
+    app.router.add_get("/{path:.*}", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port, ssl_context=context, reuse_port=reuse_port or None)
+    await site.start()
+
+    port = site._server.sockets[0].getsockname()[1]
+    print(f"READY {port}", flush=True)
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic websites over HTTPS for benchmarks.")
+    parser.add_argument("--port", type=int, default=0, help="Port to listen on, or 0 for any free port.")
+    parser.add_argument("--certs", default=".", help="Directory where the self-signed certificate is stored.")
+    parser.add_argument("--reuse-port", action="store_true", help="Share the port with other stub server processes.")
+    args = parser.parse_args()
+    asyncio.run(serve(args.port, args.certs, args.reuse_port))
+
+
+class StubProcesses(list):
+    """
+    Processes of the stub server sharing the same port, stopped together.
+    """
+
+    def terminate(self):
+        for proc in self:
+            proc.terminate()
+
+    def kill(self):
+        for proc in self:
+            proc.kill()
+
+
+def _start_process(directory: str, port: int, reuse_port: bool) -> tuple:
+    command = [sys.executable, os.path.abspath(__file__), "--certs", directory, "--port", str(port)]
+    proc = subprocess.Popen(command + (["--reuse-port"] if reuse_port else []), stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline()
+    assert line.startswith("READY"), "Stub server failed to start."
+    return proc, int(line.split()[1])
+
+
+def start_in_subprocess(directory: str, processes: int = 1) -> tuple:
+    """
+    Launch the stub server as separate processes and wait until they're listening,
+    with more than one sharing the port so it doesn't become the bottleneck.
+    Returns the processes and the port that was assigned.
+    """
+    reuse_port = processes > 1
+    proc, port = _start_process(directory, 0, reuse_port)
+    procs = StubProcesses([proc])
+    for _ in range(processes - 1):
+        procs.append(_start_process(directory, port, reuse_port)[0])
+    return procs, port
+
+
+if __name__ == "__main__":
+    main()
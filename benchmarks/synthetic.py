@@ -0,0 +1,130 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import random
+
+
+# Sentences used to build pages deterministically for a given random seed.
+LEGAL_SENTENCES = [
+    "These terms are effective as of the date you first accept them by accessing or using the service.",
+    "You are entitled to terminate your account at any time by sending a written request to our support team.",
+    "Any dispute arising out of or relating to these terms shall be resolved under the applicable law of the jurisdiction.",
+    "We are providing the service on an as-is basis and are unable to guarantee that it will always be available.",
+    "We will make reasonable efforts to protect your information from unauthorized access, processing or disclosure.",
+    "Nothing in this section precludes the enforcement of any rights that cannot be limited under applicable law.",
+    "We reserve the right to suspend or terminate the service, in whole or in part, for any purpose we decide.",
+    "Your use of the service shall not constitute a waiver of any of our rights, and we are not liable for damages.",
+    "You consent to the processing of your information as described in our privacy policy and cookie notice.",
+    "Your obligations under this agreement survive the termination of your account for the period necessary.",
+    "You are responsible for the security of your account and must notify us of any request you did not make.",
+    "Our liability is limited to the maximum extent permitted by applicable law for any purpose whatsoever.",
+    "The protection of your information is important to us and is described in the privacy section below.",
+    "We may update these terms from time to time, and the effective date will be indicated at the top of this page.",
+]
+
+TDM_CLAUSES = [
+    "You agree not to use any robot, spider, scraper or other automated means to access the service for any purpose without our express written permission.",
+    "You may not engage in data mining, scraping or similar data gathering and extraction methods in connection with the service.",
+    "Use of the content to train machine learning models or to populate a database is prohibited without a separate licence.",
+]
+
+NFP_CLAUSES = [
+    "The content is made available for your personal use only, and any commercial use without a licence is strictly prohibited.",
+    "Materials on this site are licensed for non-commercial use and may not be resold or redistributed.",
+]
+
+FRENCH_SENTENCES = [
+    "Les présentes conditions générales d'utilisation régissent l'accès au service et son utilisation par les utilisateurs.",
+    "Vous acceptez de ne pas utiliser de robots ou d'autres moyens automatisés pour accéder au contenu du site.",
+    "Nous nous réservons le droit de suspendre ou de résilier votre compte à tout moment et sans préavis.",
+    "Tout litige relatif à l'interprétation des présentes sera soumis aux tribunaux compétents de Paris.",
+    "Vos données personnelles sont traitées conformément à notre politique de confidentialité et à la loi applicable.",
+    "L'utilisateur est seul responsable de la sécurité de son mot de passe et de son identifiant de connexion.",
+]
+
+FILLER_WORDS = (
+    "photo gallery portfolio artist design collection image studio creative share discover "
+    "community trending popular new featured explore upload favorite inspiration project"
+).split()
+
+
+def _page(title: str, body: str, lang: str = "en", footer: bool = True) -> str:
+    footer = '<a href="/terms">Terms of Service</a> <a href="/privacy">Privacy Policy</a>' if footer else ""
+    return (
+        f'<!DOCTYPE html>\n<html lang="{lang}"><head><meta charset="utf-8"><title>{title}</title></head>\n'
+        f"<body>\n<header><nav><a href=\"/\">Home</a> <a href=\"/login\">Log in</a></nav></header>\n"
+        f"<main>\n{body}\n</main>\n"
+        f"<footer>{footer}</footer>\n"
+        f"</body></html>\n"
+    )
+
+
+def landing_page(rng: random.Random, links: list = None, paragraphs: int = 8, extra_links: int = 40, footer: bool = True) -> str:
+    """
+    A homepage with filler content, navigation links and optional links that are
+    given as `(href, text)` pairs, typically pointing to the Terms Of Service.
+    """
+    body = []
+    for _ in range(paragraphs):
+        body.append("<p>" + " ".join(rng.choice(FILLER_WORDS) for _ in range(rng.randint(12, 40))) + ".</p>")
+    for i in range(extra_links):
+        word = rng.choice(FILLER_WORDS)
+        body.append(f'<a href="/{word}/{i}">{word.title()} {i}</a>')
+    for href, text in links or []:
+        body.append(f'<a href="{href}">{text}</a>')
+    return _page("Welcome", "\n".join(body), footer=footer)
+
+
+def terms_page(rng: random.Random, paragraphs: int = 30, tdm: bool = True, nfp: bool = False, lang: str = "en") -> str:
+    """
+    A Terms Of Service page made of legal paragraphs, with optional clauses that
+    reserve rights for Text- and Data-Mining or restrict use to non-commercial.
+    """
+    sentences = FRENCH_SENTENCES if lang == "fr" else LEGAL_SENTENCES
+    body = ["<h1>Terms of Service</h1>"]
+    for i in range(paragraphs):
+        text = " ".join(rng.choice(sentences) for _ in range(rng.randint(2, 4)))
+        if tdm and i == paragraphs // 2:
+            text += " " + rng.choice(TDM_CLAUSES)
+        if nfp and i == paragraphs // 3:
+            text += " " + rng.choice(NFP_CLAUSES)
+        body.append(f"<h2>{i + 1}. Section</h2>\n<p>{text}</p>")
+    body.append("<ul>" + "".join(f"<li>{rng.choice(sentences)}</li>" for _ in range(8)) + "</ul>")
+    return _page("Terms of Service", "\n".join(body), lang=lang)
+
+
+def large_page(rng: random.Random, size: int = 2_000_000, links: list = None) -> str:
+    """
+    A very large page of approximately `size` characters with many nested
+    elements and links, to stress the HTML parser.
+    """
+    body, total = [], 0
+    while total < size:
+        words = " ".join(rng.choice(FILLER_WORDS) for _ in range(rng.randint(20, 80)))
+        chunk = f'<div class="card"><span>{words}</span><a href="/item/{total}">{words[:20]}</a></div>'
+        body.append(chunk)
+        total += len(chunk)
+    for href, text in links or []:
+        body.append(f'<a href="{href}">{text}</a>')
+    return _page("Catalogue", "\n".join(body))
+
+
+def corpus(seed: int = 0, count: int = 20) -> dict:
+    """
+    Build a dictionary of named synthetic pages covering all the page types.
+    """
+    rng, pages = random.Random(seed), {}
+    for i in range(count):
+        kind = ["landing", "terms-tdm", "terms-nfp", "terms-none", "terms-fr", "large"][i % 6]
+        if kind == "landing":
+            pages[f"{kind}-{i}"] = landing_page(rng, links=[("/terms", "Terms of Service"), ("/legal", "Legal")])
+        elif kind == "terms-tdm":
+            pages[f"{kind}-{i}"] = terms_page(rng, paragraphs=rng.randint(20, 80))
+        elif kind == "terms-nfp":
+            pages[f"{kind}-{i}"] = terms_page(rng, paragraphs=rng.randint(20, 80), tdm=False, nfp=True)
+        elif kind == "terms-none":
+            pages[f"{kind}-{i}"] = terms_page(rng, paragraphs=rng.randint(20, 80), tdm=False)
+        elif kind == "terms-fr":
+            pages[f"{kind}-{i}"] = terms_page(rng, paragraphs=rng.randint(20, 40), lang="fr")
+        else:
+            pages[f"{kind}-{i}"] = large_page(rng, size=rng.randint(500_000, 2_000_000), links=[("/terms", "Terms")])
+    return pages
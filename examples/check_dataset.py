@@ -4,54 +4,38 @@ import sys
 
 import asyncio
 import textwrap
-import collections
 
-from weboptout import check_domain_reservation, rsv, Status
+from weboptout import rsv, Status
+from weboptout.bulk import check_sources_in_bulk
+from weboptout.aggregate import top_domains, OptOutTotals
+from weboptout.metrics import metrics
 
 
 
-async def _check_single_domain(lock, domain):
-    async with lock:
-        print(domain, file=sys.stderr)
-        res = await check_domain_reservation(domain)
-        return domain, res
-
-
-async def main(top_k=1000, n_tasks=8):
-    # Load list of domains from one or more datasets summaries.
-    domains = collections.defaultdict(int)
-    for filename in ['data/laion2B-en.tsv', 'data/laion2B-multi.tsv', 'data/laion1B-nolang.tsv']:
-        for ln in open(filename, "r").readlines():
-            url, count = ln.rstrip('\n').split('\t')
-            domains[url] += int(count.split('.')[0].replace(',', ''))
-
-    # Get the top k=100 domains ordered by number of images.
-    domains = sorted(domains.items(), key=lambda it: it[1], reverse=True)
-    domains = domains[:top_k]
-    total = sum(d[1] for d in domains)
-
-    # Gather all the information in parallel tasks.
-    sem = asyncio.Semaphore(n_tasks)
-    tasks = [_check_single_domain(sem, k) for k, _ in domains]
-    result = dict(await asyncio.gather(*tasks))
+async def main(top_k=1000, n_tasks=8, manifest=None):
+    # Stream the domains of one or more datasets summaries, keeping the top k by number of images.
+    filenames = ['data/laion2B-en.tsv', 'data/laion2B-multi.tsv', 'data/laion1B-nolang.tsv']
+    domains = top_domains(filenames, top_k)
+    images = dict(domains)
+    rank = {k: i for i, (k, _) in enumerate(domains)}
 
     print("Domain Name                         Opt-Out              Images\n")
-    optout, failed = 0, 0
-    total = 0
-    for i, (k, v) in enumerate(domains):
-        res = result[k]
+
+    # Gather all the information in parallel tasks, resuming from the manifest if one
+    # is given, and update the totals as each result arrives.
+    totals = OptOutTotals()
+    checks = check_sources_in_bulk([k for k, _ in domains], jobs=n_tasks, retention="full", manifest=manifest)
+    async for k, res in checks:
+        v = images[k]
 
         if any('lang' in record.context and record.context['lang'] != 'en' for record in res.process):
             continue
         if all('lang' not in record.context for record in res.process):
             continue
 
-        domain, res_name = f"{i+1}) {k}", rsv.get_name(res)
+        domain, res_name = f"{rank[k]+1}) {k}", rsv.get_name(res)
         print(f"{domain:36}{res_name:^8}       {v:12,}")
-
-        total += v
-        if res == rsv.YES: optout += v
-        if res == rsv.ERROR: failed += v
+        totals.add(res, v)
 
         for record in res.process:
             print(
@@ -64,11 +48,15 @@ async def main(top_k=1000, n_tasks=8):
             summary = textwrap.wrap(res.outcome[0][1], width=72, initial_indent='   ❝', subsequent_indent='     ')
             print("\n", "\n".join(summary) + "❞")
         print()
+        print(f"TOTAL {totals}", file=sys.stderr)
+
+    print("TOTAL", f"{totals.opted_out:,}", "opted-out from ", f"{totals.available:,}.", f"(UNAVAILABLE {totals.unavailable:,})")
+    print(totals.ratio * 100, '%')
 
-    total -= failed
-    print("TOTAL", f"{optout:,}", "opted-out from ", f"{total:,}.", f"(UNAVAILABLE {failed:,})")
-    print(optout * 100 / total, '%')
+    if (resumed := metrics.counter("weboptout_bulk_resumed_total")) > 0:
+        print(f"RESUMED {resumed:,} results from {manifest}.")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Pass a manifest file like `cache/check_dataset.manifest` to resume a previous run.
+    asyncio.run(main(manifest=sys.argv[1] if len(sys.argv) > 1 else None))
@@ -3,4 +3,12 @@
 __version__ = "dev"
 
 from .types import rsv, Reservation, Status
-from .web import check_domain_reservation, check_url_reservation
+
+
+def __getattr__(name):
+    # The network stack (aiohttp, bs4, langdetect) is only imported when first needed.
+    if name in ("check_domain_reservation", "check_url_reservation"):
+        from . import web
+        globals()[name] = getattr(web, name)
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
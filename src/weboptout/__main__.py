@@ -1,17 +1,35 @@
 ## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
 
+import os
 import re
+import sys
+import json
+import time
+import asyncio
+import logging
 import textwrap
+import itertools
+import subprocess
+import collections
 
 import click
 
-from weboptout import check_domain_reservation, check_url_reservation, rsv
+from weboptout import rsv
 from weboptout.types import Status
+from weboptout.metrics import metrics
+from weboptout.shards import select_shard, merge_results, merge_caches
 
 
 @click.group()
-def main():
-    pass
+@click.option('--metrics', 'metrics_file', type=click.Path(dir_okay=False),
+              help="Write metrics on exit, as Prometheus text for `.prom` files or JSON otherwise.")
+@click.option('--metrics-interval', default=10.0, show_default=True, help="Seconds between snapshots of the metrics.")
+@click.pass_context
+def main(ctx, metrics_file, metrics_interval):
+    # Failures of individual checks are reported by the library as warnings.
+    logging.basicConfig(level=logging.WARNING, format="%(message)s", stream=sys.stderr)
+    if metrics_file is not None:
+        ctx.call_on_close(metrics.write_in_background(metrics_file, metrics_interval))
 
 
 def _run_checks(check_fn, sources):
@@ -25,6 +43,7 @@ def _run_checks(check_fn, sources):
         for record in res.process:
             print(
                 " ", "\033[92m✓\033[0m" if record[0] == Status.SUCCESS else "\033[91m𐄂\033[0m",
+                f"\033[90m{record.duration * 1000.0:7.1f}ms\033[0m" if record.duration is not None else " " * 9,
                 record[1].value,
                 dict(record[2])
             )
@@ -38,6 +57,8 @@ def _run_checks(check_fn, sources):
 @main.command()
 @click.argument('domains', nargs=-1)
 def check_domain(domains):
+    from weboptout import check_domain_reservation
+
     print(f"\n\033[1;97m{'Domain':22} Opt-Out\033[0m\n")
     return _run_checks(check_domain_reservation, domains)
 
@@ -45,6 +66,8 @@ def check_domain(domains):
 @main.command()
 @click.argument('urls', nargs=-1)
 def check_url(urls):
+    from weboptout import check_url_reservation
+
     print(f"\n\033[1;97m{'Link':22} Opt-Out\033[0m\n")
     return _run_checks(check_url_reservation, urls)
 
@@ -52,11 +75,258 @@ def check_url(urls):
 @main.command()
 @click.argument('sources', nargs=-1)
 def check(sources):
+    from weboptout import check_domain_reservation, check_url_reservation
+
     if all(re.match("^https?://", src) for src in sources):
         return check_url(sources)
     if all(not re.match("^https?://", src) for src in sources):
         return check_domain(sources)
-    raise NotImplementedError
+
+    def _check_source(source):
+        if re.match("^https?://", source):
+            return check_url_reservation(source)
+        return check_domain_reservation(source)
+
+    print(f"\n\033[1;97m{'Source':22} Opt-Out\033[0m\n")
+    return _run_checks(_check_source, sources)
+
+
+def _show_progress(done: int, started: float, counts: dict):
+    elapsed = time.monotonic() - started
+    summary = "  ".join(f"{k} {v:,}" for k, v in sorted(counts.items()))
+    sys.stderr.write(f"\r\033[K  {done:,} checked  {done / max(elapsed, 1e-6):.1f}/s  {summary}")
+    sys.stderr.flush()
+
+
+async def _run_batch(sources, jobs, output, steps, progress, manifest, deadline=None):
+    from weboptout.bulk import check_sources_in_bulk, check_urls_in_bulk, reservation_to_dict
+
+    # Lists of URLs are checked once per host, detected from the first source.
+    sources = iter(sources)
+    first = next((s for s in sources if s.strip() and not s.startswith("#")), None)
+    if first is None:
+        return
+    sources = itertools.chain([first], sources)
+    check_in_bulk = check_urls_in_bulk if re.match("^https?://", first.strip()) else check_sources_in_bulk
+
+    started, done, counts = time.monotonic(), 0, collections.Counter()
+    retention = "summary" if steps else "none"
+    options = {} if deadline is None else {"deadline": deadline}
+    async for source, res in check_in_bulk(sources, jobs=jobs, retention=retention, manifest=manifest, **options):
+        data = {"source": source, **reservation_to_dict(res, steps=steps)}
+        output.write(json.dumps(data, default=str) + "\n")
+        output.flush()
+
+        done += 1
+        counts[data["status"]] += 1
+        if progress:
+            _show_progress(done, started, counts)
+
+    if progress:
+        sys.stderr.write("\n")
+
+
+@main.command()
+@click.argument('input', type=click.File('r'), default='-')
+@click.option('--jobs', '-j', default=8, show_default=True, help="Number of checks running concurrently.")
+@click.option('--output', '-o', type=click.File('w'), default='-', help="File to write one JSON line per result.")
+@click.option('--steps', is_flag=True, help="Include the log of steps in each result.")
+@click.option('--progress/--no-progress', default=None, help="Show progress on stderr, by default if it's a terminal.")
+@click.option('--manifest', type=click.Path(dir_okay=False), default=None,
+              help="Record finished checks in this file, and skip them when the run is resumed.")
+@click.option('--shard', default=None, metavar='I/N', help="Only check sources in shard I of N, counting from zero.")
+@click.option('--deadline', type=float, default=None, help="Seconds allowed for each check, by default 60.")
+def batch(input, jobs, output, steps, progress, manifest, shard, deadline):
+    progress = sys.stderr.isatty() if progress is None else progress
+    if shard is not None:
+        index, count = map(int, shard.split("/"))
+        input = select_shard(input, index, count)
+    asyncio.run(_run_batch(input, jobs, output, steps, progress, manifest, deadline))
+
+
+def _show_report(counts: dict):
+    total = sum(counts.values())
+    click.echo(f"\n{total:,} results", err=True)
+    for status, count in sorted(counts.items(), key=lambda it: -it[1]):
+        click.echo(f"  {status:8} {count:10,}  {count * 100 / max(total, 1):5.1f}%", err=True)
+
+
+@main.command()
+@click.argument('input', type=click.Path(exists=True, dir_okay=False))
+@click.option('--processes', '-p', default=4, show_default=True, help="Number of shards, each checked by one process.")
+@click.option('--jobs', '-j', default=8, show_default=True, help="Number of checks running concurrently per process.")
+@click.option('--directory', '-d', type=click.Path(file_okay=False), default='shards', show_default=True,
+              help="Directory for the results, manifest and cache of each shard.")
+def sharded(input, processes, jobs, directory):
+    os.makedirs(directory, exist_ok=True)
+    workers = []
+    for i in range(processes):
+        base = os.path.join(directory, f"shard-{i}-of-{processes}")
+        command = [
+            sys.executable, "-m", "weboptout", "batch", input, "--no-progress", "--jobs", str(jobs),
+            "--shard", f"{i}/{processes}", "--output", base + ".jsonl", "--manifest", base + ".manifest",
+        ]
+        workers.append(subprocess.Popen(command, env=dict(os.environ, WEBOPTOUT_CACHE=base + ".cache")))
+
+    if any(w.wait() != 0 for w in workers):
+        raise click.ClickException("Some shards failed, run the same command again to resume them.")
+
+    shards = [os.path.join(directory, f"shard-{i}-of-{processes}.jsonl") for i in range(processes)]
+    with open(os.path.join(directory, "results.jsonl"), 'w') as output:
+        _show_report(merge_results(shards, output))
+
+
+@main.command()
+@click.argument('inputs', type=click.Path(exists=True, dir_okay=False), nargs=-1, required=True)
+@click.option('--output', '-o', type=click.File('w'), default='-', help="File to write the combined JSON lines.")
+@click.option('--cache', 'caches', type=click.Path(exists=True, file_okay=False), multiple=True,
+              help="Cache directory of a shard to merge into the local cache.")
+def merge(inputs, output, caches):
+    from weboptout.utils import _resolve_path
+
+    _show_report(merge_results(inputs, output))
+    if caches:
+        merged = merge_caches(caches, _resolve_path("cache/"))
+        click.echo(f"Merged {merged:,} cached entries.", err=True)
+
+
+@main.group()
+def cache():
+    pass
+
+
+@cache.command('export')
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option('--domains', type=click.File('r'), default=None, help="File with one domain per line to export, including subdomains.")
+@click.option('--max-age', type=float, default=None, help="Only export entries cached in the last number of days.")
+def cache_export(output, domains, max_age):
+    from weboptout.utils import _resolve_path
+    from weboptout.snapshot import export_cache
+
+    if domains is not None:
+        domains = {d.strip().lower().rstrip(".") for d in domains if d.strip() and not d.startswith("#")}
+    counts = export_cache(output, _resolve_path("cache/"), domains, max_age * 86400 if max_age is not None else None)
+    click.echo(f"Exported {counts['pages']:,} pages, {counts['failures']:,} failures and "
+               f"{counts['results']:,} results into {output}.", err=True)
+
+
+@cache.command('import')
+@click.argument('archive', type=click.File('rb'), default='-')
+def cache_import(archive):
+    from weboptout.utils import _resolve_path
+    from weboptout.snapshot import import_cache
+
+    counts = import_cache(archive, _resolve_path("cache/"))
+    click.echo(f"Imported {counts['pages imported']:,} pages, skipped {counts['pages skipped']:,} older; "
+               f"imported {counts['results imported']:,} results, skipped {counts['results skipped']:,}.", err=True)
+
+
+@main.command()
+@click.option('--host', default='127.0.0.1', show_default=True, help="Interface to listen on.")
+@click.option('--port', default=8080, show_default=True, help="Port to listen on.")
+@click.option('--jobs', '-j', default=32, show_default=True, help="Number of checks running concurrently.")
+@click.option('--ttl', default=86400.0, show_default=True, help="Seconds to keep results in memory.")
+def serve(host, port, jobs, ttl):
+    from aiohttp import web
+    from weboptout.server import create_app
+
+    web.run_app(create_app(jobs=jobs, ttl=ttl), host=host, port=port)
+
+
+@main.command()
+@click.argument('source', type=click.Path(exists=True, dir_okay=False), default='data/tos.jsonl')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), default=None, help="Compiled file, by default `.idx` next to the source.")
+def compile_database(source, output):
+    from weboptout.database import compile_database
+
+    output = output or os.path.splitext(source)[0] + ".idx"
+    count = compile_database(source, output)
+    click.echo(f"Compiled {count:,} patterns into {output}.")
+
+
+@main.command()
+@click.argument('inputs', type=click.File('r'), nargs=-1, required=True)
+@click.option('--output', '-o', type=click.Path(dir_okay=False), default='data/tos.jsonl', show_default=True, help="Database file to write.")
+@click.option('--header', default="## Copyright © 2023, Alex J. Champandard.  Licensed under a Fair Dealings Licence; see README! ⚘",
+              help="First line of the database file.")
+def build_database(inputs, output, header):
+    from weboptout.web import normalize_host
+    from weboptout.database import build_database
+
+    def _results():
+        for f in inputs:
+            for line in f:
+                data = json.loads(line)
+                if data["status"] != "YES" or data["url"] is None:
+                    continue
+                source = data["source"].strip()
+                host = normalize_host(source) if re.match("^https?://", source) else source.lower().rstrip(".")
+                yield host, data["url"]
+
+    count = build_database(_results(), output, header)
+    click.echo(f"Wrote {count:,} entries into {output}.")
+
+
+async def _run_top_domains(domains, jobs, output, manifest):
+    from weboptout.bulk import check_sources_in_bulk, reservation_to_dict
+    from weboptout.aggregate import OptOutTotals
+
+    counts, totals = dict(domains), OptOutTotals()
+    async for domain, res in check_sources_in_bulk(list(counts), jobs=jobs, retention="none", manifest=manifest):
+        totals.add(res, counts[domain])
+        data = {"source": domain, "count": counts[domain], **reservation_to_dict(res)}
+        output.write(json.dumps(data, default=str) + "\n")
+        output.flush()
+        sys.stderr.write(f"\r\033[K  {totals}")
+        sys.stderr.flush()
+    sys.stderr.write("\n")
+
+
+@main.command()
+@click.argument('inputs', type=click.File('r'), nargs=-1, required=True)
+@click.option('--top', '-k', default=1000, show_default=True, help="Number of domains with the highest counts.")
+@click.option('--capacity', type=int, default=None,
+              help="Approximate the counts keeping only this many domains in memory, instead of all of them.")
+@click.option('--check', is_flag=True, help="Check the top domains and report the totals of opted-out counts.")
+@click.option('--jobs', '-j', default=8, show_default=True, help="Number of checks running concurrently.")
+@click.option('--output', '-o', type=click.File('w'), default='-', help="File to write the domains, or JSON lines when checking.")
+@click.option('--manifest', type=click.Path(dir_okay=False), default=None,
+              help="Record finished checks in this file, and skip them when the run is resumed.")
+def top_domains(inputs, top, capacity, check, jobs, output, manifest):
+    from weboptout.aggregate import top_domains
+
+    domains = top_domains(inputs, top, capacity=capacity)
+    if check:
+        return asyncio.run(_run_top_domains(domains, jobs, output, manifest))
+    for domain, count in domains:
+        output.write(f"{domain}\t{count}\n")
+
+
+async def _run_recrawl(weights, store, jobs, limit):
+    from weboptout.recrawl import recrawl_domains
+
+    counts = collections.Counter()
+    async for r in recrawl_domains(weights, store=store, jobs=jobs, limit=limit):
+        counts["reclassified" if r.reclassified else "unchanged"] += 1
+        if r.previous is not None and r.previous.status != r.current.status:
+            counts["changed"] += 1
+            click.echo(f"{r.domain:36} {r.previous.status:>6} → {r.current.status:6} {r.current.url or ''}")
+    click.echo(f"\n{counts['unchanged']:,} unchanged, {counts['reclassified']:,} reclassified, "
+               f"{counts['changed']:,} changed status.", err=True)
+
+
+@main.command()
+@click.argument('input', type=click.File('r'), default='-')
+@click.option('--store', default='cache/recrawl.pkl', show_default=True, help="File with the fingerprints of previous runs.")
+@click.option('--jobs', '-j', default=8, show_default=True, help="Number of checks running concurrently.")
+@click.option('--limit', '-n', type=int, default=None, help="Only recrawl this many domains with the highest priority.")
+def recrawl(input, store, jobs, limit):
+    weights = {}
+    for line in input:
+        if (line := line.strip()) and not line.startswith("#"):
+            domain, _, weight = line.partition("\t")
+            weights[domain] = float(weight.replace(",", "") or 1.0)
+    asyncio.run(_run_recrawl(weights, store, jobs, limit))
 
 
 if __name__ == "__main__":
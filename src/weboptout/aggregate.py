@@ -0,0 +1,121 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import heapq
+import collections
+
+from .types import rsv
+
+
+__all__ = ["read_domain_counts", "SpaceSaving", "top_domains", "OptOutTotals"]
+
+
+def read_domain_counts(files):
+    """
+    Stream `(domain, count)` pairs from TSV files of dataset summaries, given as
+    filenames or iterables of lines.  Counts may be written like `1,234.0`.
+    """
+    for f in files:
+        lines = open(f, 'r') if isinstance(f, str) else f
+        try:
+            for line in lines:
+                domain, _, count = line.rstrip('\n').partition('\t')
+                if not domain or not count or domain.startswith("#"):
+                    continue
+                yield domain, int(count.split('.')[0].replace(',', ''))
+        finally:
+            if isinstance(f, str):
+                lines.close()
+
+
+class SpaceSaving:
+    """
+    Approximate counts of the heaviest keys in a stream, keeping at most `capacity`
+    keys in memory.  When full, a new key replaces the one with the lowest count
+    and inherits it, so counts are overestimated by at most that value, which is
+    kept as the error of each key.  Any key with a true count above the total
+    divided by the capacity is guaranteed to be kept.
+    """
+
+    def __init__(self, capacity: int):
+        assert capacity > 0, "Capacity must be positive."
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # Entries of (count, key) that may be stale, checked against `counts`.
+        self._heap = []
+
+    def add(self, key, count: int = 1):
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[key], self.errors[key] = count, 0
+        else:
+            minimum, evicted = self._pop_minimum()
+            del self.counts[evicted], self.errors[evicted]
+            self.counts[key], self.errors[key] = minimum + count, minimum
+
+        heapq.heappush(self._heap, (self.counts[key], key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(c, k) for k, c in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_minimum(self) -> tuple:
+        while True:
+            count, key = heapq.heappop(self._heap)
+            if self.counts.get(key) == count:
+                return count, key
+
+    def items(self):
+        return self.counts.items()
+
+
+def top_domains(files, k: int, capacity: int = None) -> list:
+    """
+    Merge the counts of domains from one or more TSV files and return the `k`
+    largest as `(domain, count)` pairs in decreasing order.  The counts are exact
+    by default, or approximate within a fixed memory of `capacity` domains.
+    """
+    if capacity is None:
+        counts = collections.Counter()
+        for domain, count in read_domain_counts(files):
+            counts[domain] += count
+    else:
+        assert capacity >= k, "Capacity must be at least the number of domains returned."
+        counts = SpaceSaving(capacity)
+        for domain, count in read_domain_counts(files):
+            counts.add(domain, count)
+
+    return heapq.nlargest(k, counts.items(), key=lambda it: it[1])
+
+
+class OptOutTotals:
+    """
+    Running totals of items like images per reservation status, updated as each
+    result arrives.  Items of sources that couldn't be checked are unavailable.
+    """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def add(self, res, count: int):
+        self.counts[rsv.get_name(res)] += count
+
+    @property
+    def opted_out(self) -> int:
+        return self.counts["YES"]
+
+    @property
+    def unavailable(self) -> int:
+        return self.counts["ERROR"]
+
+    @property
+    def available(self) -> int:
+        return sum(self.counts.values()) - self.unavailable
+
+    @property
+    def ratio(self) -> float:
+        return self.opted_out / max(self.available, 1)
+
+    def __str__(self):
+        return (f"{self.opted_out:,} opted-out from {self.available:,} ({self.ratio:.2%}), "
+                f"unavailable {self.unavailable:,}")
@@ -0,0 +1,201 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import re
+import asyncio
+import logging
+import collections
+
+from .types import rsv, Reservation
+from .metrics import metrics
+from .journal import Journal
+
+
+__all__ = ["check_sources_in_bulk", "check_urls_in_bulk", "reservation_to_dict"]
+
+
+logger = logging.getLogger(__name__)
+
+
+def reservation_to_dict(res: Reservation, steps: bool = False) -> dict:
+    """
+    Convert a reservation into a JSON-compatible dictionary, optionally including
+    the log of steps that explains how it was found.
+    """
+    data = {
+        "status": rsv.get_name(res),
+        "url": res.url,
+        "summary": res.outcome[0][1] if len(res.outcome) > 0 else None,
+    }
+    if steps:
+        data["steps"] = [
+            {
+                "status": record.status.name,
+                "step": record.step.name,
+                "duration": record.duration,
+                "context": record.context,
+            }
+            for record in res.process
+        ]
+    return data
+
+
+def _to_manifest(res: Reservation) -> tuple:
+    """
+    Entry recorded in a manifest, with large values of the log truncated as in the
+    "summary" retention so that whole pages aren't stored.
+    """
+    from .client import LogRecord, _compact_value
+
+    process = [
+        LogRecord(r.status, r.step, {k: _compact_value(v) for k, v in r.context.items()}, r.start, r.duration)
+        for r in res.process
+    ]
+    return (res._id, res.url, process, res.outcome)
+
+
+def _from_manifest(data: tuple) -> Reservation:
+    """
+    Finished result recorded in a manifest, or None if it was an error that must
+    be checked again.
+    """
+    if data is None or (res := Reservation(*data)) == rsv.ERROR:
+        return None
+    return res
+
+
+async def _check_source(source: str, **options) -> Reservation:
+    from .web import check_domain_reservation, check_url_reservation
+
+    try:
+        if re.match("^https?://", source):
+            return await check_url_reservation(source, **options)
+        return await check_domain_reservation(source, **options)
+    except Exception as exc:
+        metrics.increment("weboptout_check_errors_total", type=type(exc).__name__)
+        logger.warning("%s: %s %s", source, type(exc).__name__, exc)
+        return rsv.ERROR(url=None)
+
+
+async def check_sources_in_bulk(sources, jobs: int = 8, retention: str = "summary", manifest: str = None, **options):
+    """
+    Check domains or URLs from any iterable using a fixed number of concurrent
+    workers, and yield `(source, reservation)` as each check completes.  The input
+    is consumed lazily so it can be a file or a generator of any size.  With a
+    `manifest` file, finished checks are recorded as they complete and a restarted
+    run yields those immediately instead of checking them again, except errors
+    which are retried.  Other options
+    like a shared `connector` are passed to each check.
+    """
+    pending, results = asyncio.Queue(maxsize=jobs * 2), asyncio.Queue()
+    journal = Journal(manifest) if manifest is not None else None
+    finished = journal.load() if journal is not None else {}
+
+    async def _produce():
+        try:
+            for source in sources:
+                if not (source := source.strip()) or source.startswith("#"):
+                    continue
+                if (res := _from_manifest(finished.get(source))) is not None:
+                    metrics.increment("weboptout_bulk_resumed_total")
+                    await results.put((source, res))
+                else:
+                    await pending.put(source)
+        finally:
+            for _ in range(jobs):
+                await pending.put(None)
+
+    async def _work():
+        while (source := await pending.get()) is not None:
+            res = await _check_source(source, retention=retention, **options)
+            if journal is not None:
+                journal.put(source, _to_manifest(res))
+            await results.put((source, res))
+        await results.put(None)
+
+    tasks = [asyncio.ensure_future(_produce())] + [asyncio.ensure_future(_work()) for _ in range(jobs)]
+    try:
+        running = jobs
+        while running > 0:
+            if (item := await results.get()) is None:
+                running -= 1
+                continue
+            yield item
+        await tasks[0]
+    finally:
+        for task in tasks:
+            task.cancel()
+        if journal is not None:
+            journal.close()
+
+
+async def _iterate(items):
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def check_urls_in_bulk(urls, jobs: int = 8, retention: str = "none", window: int = 10_000, manifest: str = None, **options):
+    """
+    Check URLs from any iterable or async iterable by grouping them per host, so
+    each host is checked only once and URLs share the in-flight or finished check.
+    Results are yielded as `(url, reservation)` in the same order as the input,
+    with at most `window` URLs buffered while waiting for slow hosts.  Bare domains
+    are checked as their own host.  A `manifest` records the result of each host,
+    so a restarted run yields the URLs of finished hosts without checking them
+    again, except errors which are retried.
+    """
+    from .web import normalize_host
+
+    semaphore, hosts, queue = asyncio.Semaphore(jobs), {}, collections.deque()
+    journal = Journal(manifest) if manifest is not None else None
+
+    def _resolved(res):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(res)
+        return future
+
+    # Hosts finished by a previous run share their result like in-flight checks.
+    for host, data in (journal.load() if journal is not None else {}).items():
+        if (res := _from_manifest(data)) is not None:
+            hosts[host] = _resolved(res)
+    resumed = set(hosts)
+
+    async def _check_host(host):
+        async with semaphore:
+            res = await _check_source(host, retention=retention, **options)
+        if journal is not None:
+            journal.put(host, _to_manifest(res))
+        return res
+
+    async def _pop():
+        url, future = queue.popleft()
+        return url, await future
+
+    try:
+        async for url in _iterate(urls):
+            if not (url := url.strip()) or url.startswith("#"):
+                continue
+
+            host = normalize_host(url) if "://" in url else url.lower().rstrip(".")
+            if host == "":
+                future = _resolved(rsv.ERROR(url=None))
+            elif (future := hosts.get(host)) is None:
+                future = hosts[host] = asyncio.ensure_future(_check_host(host))
+                metrics.increment("weboptout_bulk_hosts_total")
+            elif host in resumed:
+                metrics.increment("weboptout_bulk_resumed_total")
+            queue.append((url, future))
+
+            while len(queue) >= window or (len(queue) > 0 and queue[0][1].done()):
+                yield await _pop()
+
+        while len(queue) > 0:
+            yield await _pop()
+    finally:
+        for future in hosts.values():
+            future.cancel()
+        if journal is not None:
+            journal.close()
@@ -1,17 +1,24 @@
 ## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
 
+import time
 import atexit
 import asyncio
 import aiohttp
+import functools
 import collections
 import concurrent.futures
 from contextlib import contextmanager
 
 from . import __version__
 from .types import Status
+from .steps import Steps
+from .metrics import metrics
+from .config import (
+    HOST_TIMEOUT_DEFAULT, HOST_TIMEOUT_FACTOR, HOST_TIMEOUT_MIN, HOST_TIMEOUT_MAX, HOST_CONNECT_TIMEOUT,
+)
 
 
-__all__ = ["ClientSession", "instantiate_webdriver"]
+__all__ = ["ClientSession", "DeadlineExceeded", "instantiate_webdriver"]
 
 
 class PassThrough(Exception):
@@ -20,7 +27,71 @@ class PassThrough(Exception):
         self.step = step
 
 
-LogRecord = collections.namedtuple("LogRecord", ["status", "step", "context"])
+class DeadlineExceeded(Exception):
+    """
+    Raised when a check runs out of its time budget, after logging the step.
+    """
+
+    def __init__(self, step):
+        super().__init__(f"Deadline exceeded while {step.value}.")
+        self.step = step
+
+
+class LogRecord:
+    """
+    Compact record of one step of the analysis, which can also be indexed and
+    unpacked like a tuple of (status, step, context, start, duration).
+    """
+
+    __slots__ = ("status", "step", "context", "start", "duration")
+
+    def __init__(self, status: Status, step: Steps, context: dict, start: float = None, duration: float = None):
+        self.status = status
+        self.step = step
+        self.context = context
+        self.start = start
+        self.duration = duration
+
+    def __iter__(self):
+        return iter((self.status, self.step, self.context, self.start, self.duration))
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __len__(self):
+        return 5
+
+    def __repr__(self):
+        return f"LogRecord(status={self.status}, step={self.step}, context={self.context}, duration={self.duration})"
+
+    def __reduce__(self):
+        # Enums are stored by name and interned on load, to keep pickles small.
+        return (_restore_log_record, (self.status.value, self.step.name, self.context, self.start, self.duration))
+
+
+def _restore_log_record(status, step, context, start, duration):
+    return LogRecord(Status(status), Steps[step], context, start, duration)
+
+
+# Levels of detail kept in the step log, from least to most memory hungry.
+RETENTION_LEVELS = ("none", "summary", "full")
+
+
+def _compact_value(value, limit: int = 160):
+    """
+    Shrink a value of the log context so it doesn't keep large objects alive,
+    for example a whole HTML page attached to a parsing warning.
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        items = [_compact_value(v, limit) for v in value[:8]]
+        # Keep the original length so it's clear that items were dropped.
+        return items if len(value) <= 8 else {"items": items, "total": len(value)}
+    value = value if isinstance(value, str) else str(value)
+    if len(value) <= limit:
+        return value
+    return value[:limit] + f"… [{len(value):,} chars]"
 
 
 class Log:
@@ -28,20 +99,37 @@ class Log:
     Context decorator for logging a step of the analysis.
     """
 
-    def __init__(self, log):
+    def __init__(self, log, retention: str = "full"):
         self.status = Status.ABORT
+        self.last = None
         self._log = log
+        self._last = time.monotonic()
+        self._retention = retention
 
     def __call__(self, step,
         # Active codes which force the scope to exit after logging.
         succeed: bool = None, fail: bool = None,
         # Passive codes which record the log and don't exit.
         success: bool = None, failure: bool = None,
+        # Monotonic timing of the step, by default measured since the previous record.
+        start: float = None, duration: float = None,
         # Extra information to be attached to the log record.
         **context
     ):
+        now = time.monotonic()
+        if start is None:
+            start, duration = self._last, now - self._last
+        elif duration is None:
+            duration = now - start
+        self._last = now
+
         status = Status.SUCCESS if (succeed is True or success is True or fail is False or failure is False) else Status.FAILURE
-        self._log.append(LogRecord(status, step, context))
+        self.last = (status, step)
+        if self._retention == "summary":
+            context = {k: _compact_value(v) for k, v in context.items()}
+        if self._retention != "none":
+            self._log.append(LogRecord(status, step, context, start, duration))
+        metrics.observe("weboptout_step_seconds", duration, step=step.name, status=status.name)
         if succeed is True:
             self.status = Status.SUCCESS
             raise PassThrough(Status.SUCCESS, step)
@@ -50,6 +138,60 @@ class Log:
             raise PassThrough(Status.FAILURE, step)
 
 
+async def _record_trace_event(event, session, context, params):
+    if context.trace_request_ctx is not None:
+        context.trace_request_ctx[event] = time.monotonic()
+
+
+def _create_trace_config():
+    """
+    Store the monotonic time of HTTP events in the `trace_request_ctx` dict of a request.
+    """
+    trace_config = aiohttp.TraceConfig()
+    for event in (
+        "request_start", "dns_resolvehost_start", "dns_resolvehost_end", "dns_cache_hit",
+        "connection_create_start", "connection_create_end", "connection_reuseconn", "request_headers_sent", "request_end",
+    ):
+        getattr(trace_config, "on_" + event).append(functools.partial(_record_trace_event, event))
+    return trace_config
+
+
+class HostLatency:
+    """
+    Moving average of the response time of each host, to give slow hosts that
+    respond enough time while failing fast on hosts that keep timing out.  Only
+    the most recently used hosts are remembered.
+    """
+
+    def __init__(self, alpha: float = 0.3, max_hosts: int = 100_000):
+        self.alpha = alpha
+        self.max_hosts = max_hosts
+        self._hosts = collections.OrderedDict()
+
+    def _update(self, host: str, average: float, timeouts: int):
+        self._hosts[host] = (average, timeouts)
+        self._hosts.move_to_end(host)
+        if len(self._hosts) > self.max_hosts:
+            self._hosts.popitem(last=False)
+
+    def observe(self, host: str, seconds: float):
+        average, _ = self._hosts.get(host, (None, 0))
+        self._update(host, seconds if average is None else average + self.alpha * (seconds - average), 0)
+
+    def observe_timeout(self, host: str):
+        # The average is kept, but consecutive timeouts back off the budget.
+        average, timeouts = self._hosts.get(host, (None, 0))
+        self._update(host, average, timeouts + 1)
+
+    def timeout(self, host: str) -> float:
+        average, timeouts = self._hosts.get(host, (None, 0))
+        seconds = HOST_TIMEOUT_DEFAULT if average is None else HOST_TIMEOUT_FACTOR * average
+        seconds /= 2 ** timeouts
+        return min(max(seconds, HOST_TIMEOUT_MIN), HOST_TIMEOUT_MAX)
+
+
+host_latency = HostLatency()
+
 
 class ClientSession(aiohttp.ClientSession):
 
@@ -59,23 +201,92 @@ class ClientSession(aiohttp.ClientSession):
         "X-Forwarded-For": "8.8.8.8"
     }
 
-    def __init__(self):
-        timeout = aiohttp.ClientTimeout(connect=5.0, total=10.0)
-        super().__init__(timeout=timeout, headers=self.DEFAULT_HEADERS)
+    def __init__(self, retention: str = "full", connector: aiohttp.BaseConnector = None, deadline: float = None):
+        assert retention in RETENTION_LEVELS, f"Unknown retention level {retention}."
+
+        timeout = aiohttp.ClientTimeout(connect=HOST_CONNECT_TIMEOUT, total=HOST_TIMEOUT_DEFAULT)
+        super().__init__(
+            timeout=timeout, headers=self.DEFAULT_HEADERS, trace_configs=[_create_trace_config()],
+            # A connector passed in is shared with other sessions, so it's kept open.
+            connector=connector, connector_owner=connector is None,
+        )
+        self._retention = retention
         self._steps = []
         self._output = []
+        self._current_step = None
+        # Cache keys of the pages read, the landing page with its links to terms,
+        # and the URL and HTML of the page classified last, to fingerprint checks.
+        self._fetched = []
+        self._links = None
+        self._classified = None
+        self.deadline = None if deadline is None else time.monotonic() + deadline
 
     @contextmanager
     def setup_log(self):
-        log = Log(self._steps)
+        log = Log(self._steps, self._retention)
         try:
             yield log
         except PassThrough as exc:
             assert log.status == exc.status
-            assert len(self._steps) > 0
+            assert log.last is not None
             return True
-        finally:
-            pass
+
+    def remaining(self) -> float:
+        """
+        Seconds left before the deadline of the check, infinite if there's none.
+        """
+        return float("inf") if self.deadline is None else self.deadline - time.monotonic()
+
+    def request_timeout(self, host: str) -> tuple:
+        """
+        Timeout for a request to the host, adapted to its latency and cut short by
+        the deadline, and whether the deadline is what limits it.
+        """
+        seconds = host_latency.timeout(host)
+        limited = self.remaining() < seconds
+        # A total of zero would disable the timeout in aiohttp.
+        seconds = max(1e-3, min(seconds, self.remaining()))
+        return aiohttp.ClientTimeout(total=seconds, connect=min(seconds, max(HOST_CONNECT_TIMEOUT, seconds / 2))), limited
+
+    def deadline_exceeded(self, step: Steps = None, **context):
+        """
+        Log the step that ran out of time and stop the check.
+        """
+        step = step or self._current_step or Steps.RetrieveContent
+        metrics.increment("weboptout_deadline_exceeded_total", step=step.name)
+        with self.setup_log() as report:
+            report(step, failure=True, deadline_exceeded=True, **context)
+        raise DeadlineExceeded(step)
+
+    def check_deadline(self, step: Steps = None, **context):
+        """
+        Stop the check if the deadline passed, otherwise record the step that's
+        starting so it's the one reported if time runs out during it.
+        """
+        self._current_step = step or self._current_step
+        if self.remaining() <= 0.0:
+            self.deadline_exceeded(step, **context)
+
+    async def within_deadline(self, awaitable, step: Steps = None, **context):
+        """
+        Wait for a stage that can't limit its own duration, cancelling it when
+        the deadline passes.  A timeout raised by the stage itself also stops the
+        check with `DeadlineExceeded`, after logging the step that timed out.
+        """
+        self._current_step = step or self._current_step
+        try:
+            if self.deadline is None:
+                return await awaitable
+            return await asyncio.wait_for(awaitable, timeout=max(0.0, self.remaining()))
+        except asyncio.TimeoutError:
+            if self.remaining() <= 0.0:
+                self.deadline_exceeded(step, **context)
+
+            # The stage timed out by itself, which also stops the check.
+            step = step or self._current_step or Steps.RetrieveContent
+            with self.setup_log() as report:
+                report(step, failure=True, timeout=True, **context)
+            raise DeadlineExceeded(step) from None
 
 
 class WebDriverAsyncWrapper:
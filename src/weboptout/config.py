@@ -45,3 +45,24 @@ precludes|enforcement|reserve|terminate|section|constitute|damages|liable|\
 obligations|information|processing|consent|privacy|limited|necessary|\
 purpose|decide|account|security|request|protection\
 )""", re.I)
+
+# Seconds before retrying a fetch that failed, per kind of failure, doubled after
+# every consecutive failure up to the maximum.  Missing domains rarely come back.
+FAILURE_RETRY_DELAY = {
+    "dns": 7 * 86400,
+    "timeout": 3600,
+    "connection": 3600,
+    "invalid": 86400,
+}
+FAILURE_RETRY_MAX_DELAY = 90 * 86400
+
+# Seconds allowed for checking one domain, across all its fetches and the browser.
+CHECK_DEADLINE = 60.0
+
+# Timeouts of requests to a host are a multiple of its average response time, or
+# the default for unknown hosts, halved after every timeout without a response.
+HOST_TIMEOUT_DEFAULT = 10.0
+HOST_TIMEOUT_FACTOR = 4.0
+HOST_TIMEOUT_MIN = 2.0
+HOST_TIMEOUT_MAX = 30.0
+HOST_CONNECT_TIMEOUT = 5.0
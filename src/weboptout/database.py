@@ -0,0 +1,299 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import os
+import json
+import mmap
+import struct
+import fnmatch
+import hashlib
+import collections
+
+
+__all__ = ["load_database", "compile_database", "build_database", "CompiledDatabase", "InvalidDatabase"]
+
+
+DatabaseEntry = collections.namedtuple('DatabaseEntry', ['pattern', 'url'])
+
+# Header: magic, number of records, then the size, modification time and hash
+# of the JSONL file it was compiled from to detect when it's out of date.
+HEADER = struct.Struct("<8sIQQ20s")
+MAGIC = b"WOTOSDB3"
+
+# Record: offset and length of the reversed suffix used as a sort key, the
+# pattern and the URL, then the position of the entry in the source file.
+RECORD = struct.Struct("<IIIIIII")
+
+
+def _literal_suffix(pattern: str) -> str:
+    """
+    The whole labels at the end of a pattern that any matching host ends with,
+    which is the pattern itself if it has no wildcards.
+    """
+    last = max(pattern.rfind(c) for c in "*?[]")
+    if last < 0:
+        return pattern
+    return pattern[last:].partition(".")[2]
+
+
+def _reverse_host(host: str) -> bytes:
+    return ".".join(reversed(host.split("."))).encode()
+
+
+class InvalidDatabase(Exception):
+    """
+    Raised when a file is not a compiled database in the current format.
+    """
+
+
+def _source_signature(filename: str) -> tuple:
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _source_digest(filename: str) -> bytes:
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.digest()
+
+
+class JsonDatabase:
+    """
+    Database of patterns and ToS URLs parsed from the JSONL source file.
+    """
+
+    def __init__(self, filename: str = None):
+        self.entries = []
+        if filename is None:
+            return
+        with open(filename, 'r') as f:
+            assert f.readline().startswith("## Copyright")
+            self.entries = [DatabaseEntry(*json.loads(e)) for e in f.readlines()]
+
+    def matches(self, key: str):
+        for entry in self.entries:
+            if fnmatch.fnmatch(key, entry.pattern):
+                yield entry
+
+
+class CompiledDatabase:
+    """
+    Binary form of the database that is memory-mapped and queried in place, so
+    many processes share the same pages and nothing is deserialized upfront.
+    Entries are sorted by the literal suffix of their pattern, so a lookup is a
+    binary search for each suffix of the key, regardless of how many patterns
+    have wildcards.
+    """
+
+    def __init__(self, filename: str):
+        with open(filename, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Older formats or truncated files are rejected, even with asserts disabled.
+        if len(self._data) < HEADER.size or self._data[:len(MAGIC)] != MAGIC:
+            self._data.close()
+            raise InvalidDatabase(f"{filename} is not a compiled database in the current format.")
+        _, self._count, self.source_size, self.source_mtime, self.source_digest = HEADER.unpack_from(self._data, 0)
+
+    def is_compiled_from(self, source: str) -> bool:
+        """
+        Check the JSONL file is the one this was compiled from.  If its size and
+        modification time differ, the content is compared by hash.
+        """
+        size, mtime = _source_signature(source)
+        if size != self.source_size:
+            return False
+        return mtime == self.source_mtime or _source_digest(source) == self.source_digest
+
+    def _record(self, index: int) -> tuple:
+        return RECORD.unpack_from(self._data, HEADER.size + index * RECORD.size)
+
+    def _string(self, offset: int, length: int) -> bytes:
+        return self._data[offset:offset + length]
+
+    def _find_suffix(self, suffix: str):
+        target, lo, hi = _reverse_host(suffix), 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            sfx_ofs, sfx_len, *_ = self._record(mid)
+            if self._string(sfx_ofs, sfx_len) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        # Entries with the same suffix are adjacent.
+        while lo < self._count:
+            sfx_ofs, sfx_len, pat_ofs, pat_len, url_ofs, url_len, order = self._record(lo)
+            if self._string(sfx_ofs, sfx_len) != target:
+                break
+            pattern = self._string(pat_ofs, pat_len).decode()
+            yield order, DatabaseEntry(pattern, self._string(url_ofs, url_len).decode())
+            lo += 1
+
+    def matches(self, key: str):
+        """
+        Entries whose pattern matches the key, in the order of the JSONL file.
+        """
+        labels, candidates = key.split("."), []
+        # The empty suffix for wildcards is only searched once, even for an empty key.
+        for suffix in dict.fromkeys(".".join(labels[i:]) for i in range(len(labels) + 1)):
+            candidates.extend(self._find_suffix(suffix))
+
+        for _, entry in sorted(candidates):
+            if fnmatch.fnmatch(key, entry.pattern):
+                yield entry
+
+
+def _update_signature(database: CompiledDatabase, source: str, target: str) -> CompiledDatabase:
+    """
+    Store the current modification time of the source in the header once it was
+    found identical by hash, like after a checkout or install, so it's not hashed
+    again on the next start.
+    """
+    data = bytearray(database._data)
+    HEADER.pack_into(data, 0, MAGIC, database._count, *_source_signature(source), database.source_digest)
+
+    temporary = f"{target}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, target)
+    return CompiledDatabase(target)
+
+
+def compile_database(source: str, target: str) -> int:
+    """
+    Convert the JSONL database into the binary format, returning the number of
+    records written.
+    """
+    records = sorted(
+        (_reverse_host(_literal_suffix(entry.pattern)), order, entry.pattern.encode(), entry.url.encode())
+        for order, entry in enumerate(JsonDatabase(source).entries)
+    )
+
+    # Strings are appended after the records, with duplicates stored only once.
+    blob, offsets = bytearray(), {}
+    base = HEADER.size + RECORD.size * len(records)
+
+    def _add_string(data: bytes) -> int:
+        if data not in offsets:
+            offsets[data] = base + len(blob)
+            blob.extend(data)
+        return offsets[data]
+
+    packed = bytearray(HEADER.pack(MAGIC, len(records), *_source_signature(source), _source_digest(source)))
+    for suffix, order, pattern, url in records:
+        packed += RECORD.pack(
+            _add_string(suffix), len(suffix), _add_string(pattern), len(pattern), _add_string(url), len(url), order
+        )
+
+    # Processes may compile the same database concurrently.
+    temporary = f"{target}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(packed + blob)
+    os.replace(temporary, target)
+    return len(records)
+
+
+# Labels that are shared by unrelated sites, so patterns must fix at least one
+# label that is more specific than these.
+COMMON_LABELS = {"www", "com", "net", "org", "co", "ac", "gov", "edu", "ne", "or", "go"}
+
+
+def _is_specific(labels: tuple) -> bool:
+    return any(l not in COMMON_LABELS for l in labels[:-1])
+
+
+def generalize_hosts(hosts: dict) -> list:
+    """
+    Cluster hosts that have the same ToS URL and differ in a single label, like
+    `cdn1.example.com` and `cdn2.example.com`, into patterns like `cdn*.example.com`.
+    The input maps each host to its URL, and the result is a list of patterns and
+    URLs in an order where the first match is always correct for the known hosts.
+    Each host is visited a fixed number of times, so it scales linearly.
+    """
+    # Index suffixes of all hosts, to reject patterns covering other URLs.
+    suffixes = collections.defaultdict(set)
+    for host, url in hosts.items():
+        labels = host.split(".")
+        for i in range(1, len(labels)):
+            suffixes[".".join(labels[i:])].add(url)
+
+    remaining = {url: [] for url in hosts.values()}
+    for host, url in hosts.items():
+        remaining[url].append(tuple(host.split(".")))
+
+    exact, patterns = [], []
+    for url, group in remaining.items():
+        # Greedily replace one label at a time, starting from the leftmost.
+        for position in range(max(map(len, group)) - 1):
+            clusters = collections.defaultdict(list)
+            for labels in group:
+                if position < len(labels) - 1:
+                    clusters[labels[:position] + labels[position + 1:]].append(labels)
+
+            covered = set()
+            for fixed, members in clusters.items():
+                suffix = fixed[position:]
+                if len(members) < 2 or not _is_specific(suffix) or suffixes[".".join(suffix)] != {url}:
+                    continue
+                prefix = os.path.commonprefix([m[position] for m in members]).rstrip("-")
+                patterns.append(DatabaseEntry(".".join(fixed[:position] + (prefix + "*",) + suffix), url))
+                covered.update(members)
+            group = [labels for labels in group if labels not in covered]
+
+        exact.extend(DatabaseEntry(".".join(labels), url) for labels in group)
+
+    # Patterns never cover hosts of other groups, but exact entries are faster.
+    return exact + patterns
+
+
+def build_database(results, target: str, header: str) -> int:
+    """
+    Write a database in JSONL format from `(host, url)` pairs of successful checks,
+    returning the number of entries.  When a host appears more than once, the last
+    result is used.
+    """
+    entries = generalize_hosts(dict(results))
+    with open(target + ".tmp", 'w') as f:
+        f.write(header.rstrip("\n") + "\n")
+        for entry in entries:
+            f.write(json.dumps(list(entry)) + "\n")
+    os.replace(target + ".tmp", target)
+    return len(entries)
+
+
+def load_database(archive: str):
+    """
+    Open the compiled form of the database if it's available and was built from
+    the same JSONL file.  If it's outdated or in an older format, it's compiled
+    again when possible, otherwise that file is parsed.  The database is empty if
+    neither exists.  A JSONL file that was only touched is hashed once, then its
+    new modification time is stored in the compiled form.
+    """
+    compiled = os.path.splitext(archive)[0] + ".idx"
+    if os.path.isfile(compiled):
+        try:
+            database = CompiledDatabase(compiled)
+            if not os.path.isfile(archive):
+                return database
+            if database.is_compiled_from(archive):
+                if database.source_mtime != _source_signature(archive)[1]:
+                    try:
+                        return _update_signature(database, archive, compiled)
+                    except OSError:
+                        pass
+                return database
+        except InvalidDatabase:
+            if not os.path.isfile(archive):
+                return JsonDatabase()
+
+        try:
+            compile_database(archive, compiled)
+            return CompiledDatabase(compiled)
+        except OSError:
+            # Read-only installation, the JSONL file is still correct.
+            pass
+
+    if os.path.isfile(archive):
+        return JsonDatabase(archive)
+    return JsonDatabase()
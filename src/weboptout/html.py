@@ -1,7 +1,12 @@
 ## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
 
 import re
+import bisect
+import hashlib
 import warnings
+import collections
+from array import array
+
 import langdetect
 from bs4 import BeautifulSoup
 
@@ -10,7 +15,32 @@ from .config import RE_TDM_CONCEPTS, RE_LEGAL_WORDS, RE_NFP_CONCEPTS
 from .steps import Steps as S
 
 
-__all__ = ["check_tos_reservation"]
+__all__ = ["check_tos_reservation", "classify_texts", "fingerprint_paragraphs"]
+
+
+def _match_paragraph(patterns: list, line: str) -> tuple:
+    """
+    Apply all the patterns in order to one paragraph and explain the first match
+    with the surrounding sentence, or return None.
+    """
+    for rank, regexp in enumerate(patterns):
+        match = regexp.search(line.rstrip("\n"))
+        if not match:
+            continue
+
+        i, j = match.start(), match.end() - 1
+        while line[i] not in "().;" and i > 0:
+            i -= 1
+        while line[j] not in "().;" and j + 1 < len(line):
+            j += 1
+
+        explain = line[i : j + 1].lstrip("().,; ").rstrip("() ")
+        return (rank, explain, line)
+    return None
+
+
+def _sort_reasons(reasons: list) -> list[tuple]:
+    return sorted(reasons, key=lambda x: x[0] * 1000 - len(x[1]))
 
 
 def _find_matching_paragraphs(patterns: list, text: str) -> list[tuple]:
@@ -19,31 +49,117 @@ def _find_matching_paragraphs(patterns: list, text: str) -> list[tuple]:
     there's a match.  The results are sorted by rank of the pattern to find which
     is the most important.
     """
-    reasons = []
-    for line in text.split("\n"):
-        for rank, regexp in enumerate(patterns):
-            match = regexp.search(line.rstrip("\n"))
-            if not match:
-                continue
+    reasons = [_match_paragraph(patterns, line) for line in text.split("\n")]
+    return _sort_reasons([r for r in reasons if r is not None])
 
-            i, j = match.start(), match.end() - 1
-            while line[i] not in "().;" and i > 0:
-                i -= 1
-            while line[j] not in "().;" and j + 1 < len(line):
-                j += 1
 
-            explain = line[i : j + 1].lstrip("().,; ").rstrip("() ")
-            reasons.append((rank, explain, line))
-            break
+def _single_line(pattern: str) -> str:
+    """
+    Rewrite a pattern so that it never matches a newline, by excluding them from
+    character classes and escapes like `\\s`, so matches over many joined lines
+    stay within one line and can't backtrack over the whole text.
+    """
+    output, i = [], 0
+    while i < len(pattern):
+        if pattern[i] == "\\":
+            escape = pattern[i : i + 2]
+            output.append(f"(?:(?!\\n){escape})" if escape in ("\\s", "\\W", "\\D") else escape)
+            i += 2
+        elif pattern[i] == "[":
+            j = i + 1 + (pattern[i + 1] == "^")
+            j += pattern[j] == "]"
+            while pattern[j] != "]":
+                j += 2 if pattern[j] == "\\" else 1
+            output.append(f"(?:(?!\\n){pattern[i : j + 1]})")
+            i = j + 1
+        else:
+            output.append(pattern[i])
+            i += 1
+    return "".join(output)
+
+
+def _fold_case(text: str) -> str:
+    """
+    Lowercase text so that case-sensitive patterns in lowercase ASCII match it like
+    the original patterns with IGNORECASE, which is much faster.  The characters
+    that IGNORECASE matches with ASCII letters are replaced, and the length of the
+    text doesn't change.
+    """
+    return text.replace("\u0130", "i").replace("\u0131", "i").replace("\u017f", "s").lower()
 
-    return sorted(reasons, key=lambda x: x[0] * 1000 - len(x[1]))
 
+def _fold_pattern(regexp: re.Pattern, single_line: bool) -> re.Pattern:
+    assert not re.search("[A-Z]", re.sub(r"\\.", "", regexp.pattern)), "Expected lowercase pattern."
+    return re.compile(_single_line(regexp.pattern) if single_line else regexp.pattern, re.M)
+
+
+# Case-folded versions of the patterns, each applied once to many texts joined together.
+RE_TDM_FOLDED = [_fold_pattern(p, single_line=True) for p in RE_TDM_CONCEPTS]
+RE_NFP_FOLDED = [_fold_pattern(p, single_line=True) for p in RE_NFP_CONCEPTS]
+RE_LEGAL_FOLDED = _fold_pattern(RE_LEGAL_WORDS, single_line=False)
+
+
+ClassifiedText = collections.namedtuple('ClassifiedText', ['tdm', 'nfp', 'legal_words'])
 
-def check_tos_reservation(client, url: str, html: str) -> Status:
-    with warnings.catch_warnings(record=True) as w:
-        soup = BeautifulSoup(html, "html.parser")
 
+def _candidate_lines(patterns: list, text: str, line_starts: array) -> list[int]:
+    """
+    Indices of the lines touched by any match of the patterns, which includes every
+    line where one of the original patterns matches.
+    """
+    candidates = set()
+    for regexp in patterns:
+        for match in regexp.finditer(text):
+            first = bisect.bisect_right(line_starts, match.start()) - 1
+            last = bisect.bisect_right(line_starts, match.end() - 1) - 1
+            candidates.update(range(first, last + 1))
+    return sorted(candidates)
+
+
+def classify_texts(texts: list[str]) -> list[ClassifiedText]:
+    """
+    Classify the paragraphs of many extracted texts at once, as joined by newlines
+    in `check_tos_reservation`.  All texts are scanned together once per pattern,
+    and only paragraphs touched by a match are checked one pattern at a time, so
+    the results are identical to `_find_matching_paragraphs` for each text.  Legal
+    words are counted in the same pass over all texts.
+    """
+    joined = "\n".join(texts)
+    folded, lines = _fold_case(joined), joined.split("\n")
+
+    line_starts, offset = array('q'), 0
+    for line in lines:
+        line_starts.append(offset)
+        offset += len(line) + 1
+
+    # Index of the first line and the first character of each text.
+    text_lines, text_starts, line, offset = array('q'), array('q'), 0, 0
+    for text in texts:
+        text_lines.append(line)
+        text_starts.append(offset)
+        line += text.count("\n") + 1
+        offset += len(text) + 1
+
+    results = {}
+    for name, folded_patterns, patterns in (("tdm", RE_TDM_FOLDED, RE_TDM_CONCEPTS), ("nfp", RE_NFP_FOLDED, RE_NFP_CONCEPTS)):
+        reasons = [[] for _ in texts]
+        for index in _candidate_lines(folded_patterns, folded, line_starts):
+            if (reason := _match_paragraph(patterns, lines[index])) is not None:
+                reasons[bisect.bisect_right(text_lines, index) - 1].append(reason)
+        results[name] = [_sort_reasons(r) for r in reasons]
+
+    legal_words = array('q', bytes(8 * len(texts)))
+    for match in RE_LEGAL_FOLDED.finditer(folded):
+        legal_words[bisect.bisect_right(text_starts, match.start()) - 1] += 1
+
+    return [ClassifiedText(*fields) for fields in zip(results["tdm"], results["nfp"], legal_words)]
+
+
+def check_tos_reservation(client, url: str, html: str) -> Status:
     with client.setup_log() as report:
+        with warnings.catch_warnings(record=True) as w:
+            soup = BeautifulSoup(html, "html.parser")
+
         report(S.ParsePage, fail=len(w) > 0, url=url, **{'html': html, 'warnings': w} if len(w) > 0 else {})
 
         text = "\n".join(_extract_paragraphs(soup))
@@ -55,8 +171,10 @@ def check_tos_reservation(client, url: str, html: str) -> Status:
         report(S.ValidateTextLanguage, fail=bool(lang != "en"), lang=lang)
         assert lang == 'en'
 
+        classified = classify_texts([text])[0]
+
         # Words that match data-mining concepts.
-        reasons = _find_matching_paragraphs(RE_TDM_CONCEPTS, text)
+        reasons = classified.tdm
         if len(reasons) > 0:
             client._output.append((1234, reasons[0][1], reasons[0][2]))
 
@@ -68,7 +186,7 @@ def check_tos_reservation(client, url: str, html: str) -> Status:
         )
 
         # Words that match not-for-profit reservations.
-        reasons = _find_matching_paragraphs(RE_NFP_CONCEPTS, text)
+        reasons = classified.nfp
         if len(reasons) > 0:
             client._output.append((5678, reasons[0][1], reasons[0][2]))
 
@@ -81,16 +199,15 @@ def check_tos_reservation(client, url: str, html: str) -> Status:
 
         report(S.ExtractText, fail=len(text) < 2_000)
 
-        legal_words = RE_LEGAL_WORDS.findall(text)
-        report(S.ValidateLegalText, fail=len(legal_words) < 36)
+        report(S.ValidateLegalText, fail=classified.legal_words < 36)
 
-    if tuple(client._steps[-1][0:2]) == (Status.FAILURE, S.ValidateTextLanguage):
+    if report.last == (Status.FAILURE, S.ValidateTextLanguage):
         return Status.ABORT
 
-    if tuple(client._steps[-1][0:2]) == (Status.FAILURE, S.ExtractText):
+    if report.last == (Status.FAILURE, S.ExtractText):
         return Status.RETRY
 
-    assert len(client._steps) > 0
+    assert report.last is not None
     assert report.status is not None
     return report.status
 
@@ -118,7 +235,20 @@ def _extract_paragraphs(soup):
             continue
 
         text = (
-            " ".join(para.findAll(text=True, recursive=True)).replace("\n", " ").strip()
+            " ".join(para.find_all(string=True, recursive=True)).replace("\n", " ").strip()
         )
         if text != "":
             yield re_cleanup.sub(" ", text)
+
+
+def fingerprint_paragraphs(html: str) -> str:
+    """
+    Hash of the paragraphs extracted from a page, which only changes when the text
+    that is classified changes, not the markup or scripts around it.
+    """
+    with warnings.catch_warnings(record=True):
+        soup = BeautifulSoup(html, "html.parser")
+    digest = hashlib.sha1()
+    for para in _extract_paragraphs(soup):
+        digest.update(para.encode() + b"\n")
+    return digest.hexdigest()
@@ -1,42 +1,120 @@
 ## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
 
+import time
+import socket
 import asyncio
 import aiohttp
 import warnings
 import itertools
 from dataclasses import dataclass
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit
 
 from bs4 import BeautifulSoup
 
-from .config import RE_HREF_TOS, RE_TEXT_TOS
+from .config import RE_HREF_TOS, RE_TEXT_TOS, FAILURE_RETRY_DELAY, FAILURE_RETRY_MAX_DELAY
 from .utils import cache_to_directory, retrieve_from_database, limit_concurrency
-from .client import instantiate_webdriver
+from .client import instantiate_webdriver, host_latency
+from .metrics import metrics
 from .steps import Steps as S
 
 
 __all__ = ["search_tos_for_domain"]
 
 
+@dataclass
+class FetchFailure:
+    """
+    Stored in place of the response headers when a fetch failed, so the failure
+    is cached until it expires with a delay that grows after each attempt.
+    """
+
+    kind: str
+    failed_at: float
+    attempts: int = 1
+
+    @property
+    def expires_at(self) -> float:
+        delay = FAILURE_RETRY_DELAY[self.kind] * 2 ** (self.attempts - 1)
+        return self.failed_at + min(delay, FAILURE_RETRY_MAX_DELAY)
+
+
+def _is_expired_failure(result: tuple) -> bool:
+    url, headers, html = result
+    if html is not None:
+        return False
+    # Failures cached before they were recorded explicitly are always retried.
+    if not isinstance(headers, FetchFailure):
+        return True
+    return time.time() >= headers.expires_at
+
+
 def _log_cache_hit(client, url, /, filename, result):
+    if _is_expired_failure(result):
+        return True
+
+    failure = {"reason": result[1].kind, "attempts": result[1].attempts} if result[-1] is None else {}
     with client.setup_log() as report:
-        report(S.RetrieveContent, succeed=bool(result[-1] not in ("", None)), cache=filename, url=url)
+        report(S.RetrieveContent, succeed=bool(result[-1] not in ("", None)), cache=filename, url=url, **failure)
+
+
+def _count_failures(previous, result):
+    if result[-1] is None and isinstance(previous[1], FetchFailure):
+        result[1].attempts = previous[1].attempts + 1
+    return result
+
+
+# Raised by aiohttp 3.11 and later for failed lookups with any resolver, including
+# the one based on aiodns which doesn't raise `socket.gaierror`.
+ClientConnectorDNSError = getattr(aiohttp, "ClientConnectorDNSError", None)
+
+
+def _classify_connection_error(exc: aiohttp.ClientError) -> str:
+    os_error = getattr(exc, "os_error", None)
+    # Temporary failures of the resolver are retried as soon as connections.
+    if isinstance(os_error, socket.gaierror) and os_error.errno == socket.EAI_AGAIN:
+        return "connection"
+    if ClientConnectorDNSError is not None and isinstance(exc, ClientConnectorDNSError):
+        return "dns"
+    if isinstance(os_error, socket.gaierror):
+        return "dns"
+    return "connection"
 
 
-@cache_to_directory("cache/www", key="url", filter=_log_cache_hit)
+def _timing(trace: dict, begin: str, end: str = None) -> dict:
+    """
+    Convert events recorded by the client's trace config into `start` and `duration`
+    arguments of a log record.  If they are missing because the step was skipped,
+    e.g. the DNS cache was hit or a connection was reused, the duration is zero.
+    """
+    if begin not in trace or (end is not None and end not in trace):
+        return {"start": trace["request_start"], "duration": 0.0} if "request_start" in trace else {}
+    return {"start": trace[begin], "duration": trace.get(end, time.monotonic()) - trace[begin]}
+
+
+@cache_to_directory("cache/www", key="url", filter=_log_cache_hit, merge=_count_failures)
 async def _fetch_from_cache_or_network(client, url: str) -> tuple:
+    client.check_deadline(S.RetrieveContent, url=url)
+
+    trace, host = {}, urlsplit(url).hostname or ""
+    timeout, limited = client.request_timeout(host)
     try:
-        async with client.get(url) as response:
+        async with client.get(url, trace_request_ctx=trace, timeout=timeout) as response:
             # Add dict(response.headers) to context
             # Add response.url to context.
 
             html = ""
+            metrics.increment("weboptout_http_responses_total", code=response.status)
 
             with client.setup_log() as report:
-                report(S.ResolveDomain, success=True, domain=response.url.host)
-                report(S.EstablishConnection, success=True, address=response.connection.transport.get_extra_info('peername') if response.connection else '')
+                report(S.ResolveDomain, success=True, domain=response.url.host,
+                       **({"cached": True} if "dns_cache_hit" in trace else {}),
+                       **_timing(trace, "dns_resolvehost_start", "dns_resolvehost_end"))
+                report(S.EstablishConnection, success=True, address=response.connection.transport.get_extra_info('peername') if response.connection else '',
+                       **({"reused": True} if "connection_reuseconn" in trace else {}),
+                       **_timing(trace, "connection_create_start", "connection_create_end"))
 
-                report(S.RetrieveContent, success=bool(response.status == 200), status_code=response.status, url=url)
+                report(S.RetrieveContent, success=bool(response.status == 200), status_code=response.status, url=url,
+                       **_timing(trace, "request_headers_sent", "request_end"))
 
                 report(
                     S.ValidateContentFormat,
@@ -51,25 +129,39 @@ async def _fetch_from_cache_or_network(client, url: str) -> tuple:
 
                 report(S.ValidateContentLength, fail=len(html) == 0, bytes=len(html))
 
+            if "request_start" in trace:
+                host_latency.observe(host, time.monotonic() - trace["request_start"])
             return str(response.url), dict(response.headers), html
 
     except asyncio.exceptions.TimeoutError as exc:
+        # Out of time for the whole check, which says nothing about the host.
+        if limited:
+            client.deadline_exceeded(S.RetrieveContent, url=url, **_timing(trace, "request_start"))
+
+        metrics.increment("weboptout_http_errors_total", type="timeout")
+        host_latency.observe_timeout(host)
+        failure = "timeout"
         with client.setup_log() as report:
-            report(S.ResolveDomain, fail=True, exception=str(exc))
+            report(S.ResolveDomain, fail=True, exception=str(exc), **_timing(trace, "request_start"))
 
     except aiohttp.ClientError as exc:
+        metrics.increment("weboptout_http_errors_total", type=type(exc).__name__)
+        failure = _classify_connection_error(exc)
         with client.setup_log() as report:
-            report(S.EstablishConnection, fail=True, exception=str(exc))
+            report(S.EstablishConnection, fail=True, exception=str(exc), **_timing(trace, "request_start"))
 
     except AssertionError as exc:
+        metrics.increment("weboptout_http_errors_total", type="assertion")
+        failure = "invalid"
         with client.setup_log() as report:
             report(S.EstablishConnection, fail=True, exception=str(exc))
 
-    return url, {}, None
+    return url, FetchFailure(failure, time.time()), None
 
 
 @retrieve_from_database("data/tos.jsonl", key="url")
 async def _find_tos_links_from_url(client, url: str) -> list[str]:
+    client._fetched.append(url)
     url, _, html = await _fetch_from_cache_or_network(client, url)
 
     if html is None:
@@ -82,10 +174,10 @@ async def _find_tos_links_from_url(client, url: str) -> list[str]:
 
 
 async def _find_tos_links_from_html(client, url, html: str) -> list[str]:
-    with warnings.catch_warnings(record=True) as w:
-        soup = BeautifulSoup(html, "html.parser")
-    
     with client.setup_log() as report:
+        with warnings.catch_warnings(record=True) as w:
+            soup = BeautifulSoup(html, "html.parser")
+
         links = []
         report(S.ParsePage, fail=len(w) > 0, url=url, **{'html': html, 'warnings': w} if len(w) > 0 else {})
 
@@ -152,24 +244,27 @@ def _reject_if_header_missing(url, headers, /, filename, result):
 @cache_to_directory("cache/www", key="url", filter=_reject_if_header_missing)
 @limit_concurrency(value=1)
 async def _fetch_from_browser_then_cache_result(url, headers):
+    metrics.increment("weboptout_webdriver_pages_total")
+    webdriver = instantiate_webdriver()
     try:
-        webdriver = instantiate_webdriver()
-        await webdriver.open_tab(url)
-    except Exception as exc: # selenium.common.exceptions.TimeoutException
+        # Cancelled by the deadline at any point, so the tab is always closed.
+        try:
+            await webdriver.open_tab(url)
+        except Exception as exc: # selenium.common.exceptions.TimeoutException
+            if "Message: Navigation timed out after" not in str(exc):
+                raise
+            return url, headers, ""
+
+        for i in range(100):
+            if not (await webdriver.is_page_loading(url)):
+                break
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(2.0)
+
+        html = await webdriver.get_page_html()
+        headers["User-Agent"] = "WebOptOut/Firefox"
+    finally:
         await webdriver.close_tab()
-        if "Message: Navigation timed out after" not in str(exc):
-            raise
-        return url, headers, ""
-
-    for i in range(100):
-        if not (await webdriver.is_page_loading(url)):
-            break
-        await asyncio.sleep(0.05)
-    await asyncio.sleep(2.0)
-
-    html = await webdriver.get_page_html()
-    headers["User-Agent"] = "WebOptOut/Firefox"
-    await webdriver.close_tab()
 
     return url, headers, html
 
@@ -184,8 +279,8 @@ async def search_tos_for_domain(client, domain: str, attempts: int = 4) -> str:
 
     # Step 1) find the right domain from the domain.
     while domain.count(".") > 0:
-        links = []
-        url, links = await _find_tos_links_from_url(client, "https://" + domain)
+        links, home = [], "https://" + domain
+        url, links = await _find_tos_links_from_url(client, home)
 
         if url is None or len(links or []) == 0:
             domain = ".".join(domain.split(".")[1:])
@@ -196,6 +291,7 @@ async def search_tos_for_domain(client, domain: str, attempts: int = 4) -> str:
     # No data from server, just terminate.
     if links is None:
         return
+    client._links = (home, tuple(links))
 
     # Content received but no links.
     if len(links) == 0:
@@ -208,6 +304,7 @@ async def search_tos_for_domain(client, domain: str, attempts: int = 4) -> str:
         url = links.pop(0)
         visited.add(url)
 
+        client._fetched.append(url)
         new_url, headers, html = await _fetch_from_cache_or_network(client, url)
         if html is None:
             continue
@@ -216,7 +313,14 @@ async def search_tos_for_domain(client, domain: str, attempts: int = 4) -> str:
         yield new_url, html, options
 
         if options.retry:
-            url, headers, html = await _fetch_from_browser_then_cache_result(url, headers)
+            metrics.increment("weboptout_retries_total")
+            client.check_deadline(S.RetrievePage, url=url, browser=True)
+            started = time.monotonic()
+            url, headers, html = await client.within_deadline(
+                _fetch_from_browser_then_cache_result(url, headers), S.RetrievePage, url=url, browser=True
+            )
+            with client.setup_log() as report:
+                report(S.RetrievePage, success=bool(html), url=url, browser=True, start=started)
             yield url, html, options
 
         url, further_links = await _find_tos_links_from_html(client, url, html)
@@ -0,0 +1,163 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import os
+import time
+import zlib
+import pickle
+import struct
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+__all__ = ["Journal"]
+
+
+# Record: marker, length and checksum of the payload, which is a pickled tuple
+# of the operation, the key, the value and the time of the change.
+RECORD = struct.Struct("<4sII")
+MARKER = b"WOJ1"
+
+
+@contextlib.contextmanager
+def _locked(filename: str, exclusive: bool):
+    """
+    Hold an advisory lock shared by all processes using the same journal, which
+    is a no-op on platforms without `fcntl`.
+    """
+    # Every access takes the lock first, so it creates the directory of the journal.
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    if fcntl is None:
+        yield
+        return
+
+    with open(filename, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_records(data: bytes):
+    """
+    Decode all complete records, skipping over any that are torn or corrupted by
+    searching for the next marker.
+    """
+    offset = 0
+    while (offset := data.find(MARKER, offset)) >= 0 and offset + RECORD.size <= len(data):
+        _, length, checksum = RECORD.unpack_from(data, offset)
+        payload = data[offset + RECORD.size:offset + RECORD.size + length]
+        if len(payload) == length and zlib.crc32(payload) == checksum:
+            try:
+                yield pickle.loads(payload)
+                offset += RECORD.size + length
+                continue
+            except Exception:
+                pass
+        offset += 1
+
+
+class Journal:
+    """
+    Dictionary persisted as a snapshot file plus an append-only journal of the
+    changes since, so every change is on disk as soon as it's made and its cost
+    doesn't depend on the size of the dictionary.  The journal is compacted into
+    the snapshot once it grows larger than it, and multiple processes can safely
+    share the same files.
+    """
+
+    def __init__(self, filename: str, min_compact_size: int = 1 << 20):
+        self.filename = filename
+        self.journal = filename + ".journal"
+        self.lockfile = filename + ".lock"
+        self.min_compact_size = min_compact_size
+        self._file = None
+
+    def _read(self) -> tuple:
+        state, times = {}, {}
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'rb') as f:
+                state.update(pickle.load(f))
+                # Times follow the state, except in snapshots of older versions.
+                with contextlib.suppress(EOFError):
+                    times.update(pickle.load(f))
+        if os.path.isfile(self.journal):
+            with open(self.journal, 'rb') as f:
+                for op, key, value, *changed in _read_records(f.read()):
+                    if op == "put":
+                        state[key], times[key] = value, changed[0] if changed else None
+                    else:
+                        state.pop(key, None)
+                        times.pop(key, None)
+        return state, times
+
+    def load(self) -> dict:
+        """
+        Read the snapshot and replay the journal, compacting it if it's large.
+        """
+        with _locked(self.lockfile, exclusive=False):
+            state, _ = self._read()
+        if self._should_compact():
+            self.compact()
+        return state
+
+    def read(self) -> tuple:
+        """
+        Read the state and the time each entry was last changed, or None if it's
+        unknown, without ever compacting the files.
+        """
+        if not os.path.isfile(self.filename) and not os.path.isfile(self.journal):
+            return {}, {}
+        with _locked(self.lockfile, exclusive=False):
+            return self._read()
+
+    def _should_compact(self) -> bool:
+        if not os.path.isfile(self.journal):
+            return False
+        size = os.path.getsize(self.journal)
+        snapshot = os.path.getsize(self.filename) if os.path.isfile(self.filename) else 0
+        return size > max(self.min_compact_size, snapshot)
+
+    def _append(self, op: str, key, value=None, changed: float = None):
+        payload = pickle.dumps((op, key, value, time.time() if changed is None else changed))
+        with _locked(self.lockfile, exclusive=False):
+            if self._file is None:
+                self._file = open(self.journal, 'ab', buffering=0)
+            # One unbuffered write in append mode, so records are never interleaved.
+            self._file.write(RECORD.pack(MARKER, len(payload), zlib.crc32(payload)) + payload)
+
+        if self._should_compact():
+            self.compact()
+
+    def put(self, key, value, changed: float = None):
+        self._append("put", key, value, changed)
+
+    def delete(self, key):
+        self._append("del", key)
+
+    def compact(self):
+        """
+        Write the current state from disk as a new snapshot and empty the journal,
+        including changes made by other processes.
+        """
+        with _locked(self.lockfile, exclusive=True):
+            state, times = self._read()
+            with open(self.filename + ".tmp", 'wb') as f:
+                pickle.dump(state, f)
+                pickle.dump({k: t for k, t in times.items() if t is not None}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.filename + ".tmp", self.filename)
+
+            # Other processes keep appending to the same file, now empty.
+            with open(self.journal, 'ab') as f:
+                f.truncate(0)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,205 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import os
+import json
+import time
+import bisect
+import collections
+
+
+__all__ = ["metrics", "MetricsRegistry"]
+
+
+# Upper bounds in seconds of the histogram buckets, the last one being +Inf.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram that is cheap to update, from which approximate
+    percentiles can be computed when exporting.
+    """
+
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate the q-th quantile by linear interpolation within its bucket.
+        """
+        if self.count == 0:
+            return None
+
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n > 0:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+def _format_labels(labels: tuple, **extra) -> str:
+    items = list(labels) + list(extra.items())
+    if len(items) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms keyed by name and labels.  Labels are stored in the
+    order they are passed, so each call site should always use the same order.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters = collections.defaultdict(int)
+        self.histograms = {}
+
+    def increment(self, name: str, value: int = 1, **labels):
+        self.counters[(name, tuple(labels.items()))] += value
+
+    def counter(self, name: str, **labels) -> int:
+        """
+        Value of the counter with these labels, or zero if it was never incremented.
+        """
+        return self.counters.get((name, tuple(labels.items())), 0)
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(labels.items()))
+        if (histogram := self.histograms.get(key)) is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.counters.clear()
+        self.histograms.clear()
+
+    def to_prometheus(self) -> str:
+        """
+        Export all the metrics in the Prometheus text exposition format.
+        """
+        lines = [
+            "# TYPE weboptout_uptime_seconds gauge",
+            f"weboptout_uptime_seconds {time.monotonic() - self.started:.3f}",
+        ]
+
+        declared = set()
+        # Copies are atomic, while the metrics may be updated by another thread.
+        counters, histograms = dict(self.counters), dict(self.histograms)
+        for (name, labels), value in sorted(counters.items()):
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for (name, labels), hist in sorted(histograms.items()):
+            if name not in declared:
+                lines.append(f"# TYPE {name} histogram")
+                declared.add(name)
+            total = 0
+            for bound, n in zip(hist.buckets + ("+Inf",), hist.counts):
+                total += n
+                lines.append(f"{name}_bucket{_format_labels(labels, le=bound)} {total}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {hist.sum:.6f}")
+            lines.append(f"{name}_count{_format_labels(labels)} {hist.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> dict:
+        """
+        Export a snapshot of all metrics, including rates and latency percentiles.
+        """
+        uptime = time.monotonic() - self.started
+        counters, histograms = dict(self.counters), dict(self.histograms)
+        checks = sum(h.count for (n, _), h in histograms.items() if n == "weboptout_check_seconds")
+        return {
+            "time": time.time(),
+            "uptime": uptime,
+            "checks_per_second": checks / uptime if uptime > 0 else 0.0,
+            "counters": {
+                name + _format_labels(labels): value
+                for (name, labels), value in sorted(counters.items())
+            },
+            "histograms": {
+                name + _format_labels(labels): {
+                    "count": h.count,
+                    "sum": h.sum,
+                    "p50": h.quantile(0.50),
+                    "p95": h.quantile(0.95),
+                    "p99": h.quantile(0.99),
+                }
+                for (name, labels), h in sorted(histograms.items())
+            },
+        }
+
+    def write(self, filename: str):
+        """
+        Atomically write the metrics to a file, as Prometheus text if the extension
+        is `.prom` or `.txt` and as a JSON snapshot otherwise.
+        """
+        if filename.endswith((".prom", ".txt")):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_json(), indent=2)
+
+        with open(filename + ".tmp", "w") as f:
+            f.write(content)
+        os.replace(filename + ".tmp", filename)
+
+    async def write_periodically(self, filename: str, interval: float = 10.0):
+        """
+        Coroutine that writes a snapshot every `interval` seconds until cancelled.
+        """
+        import asyncio
+
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                self.write(filename)
+        finally:
+            self.write(filename)
+
+    def write_in_background(self, filename: str, interval: float = 10.0):
+        """
+        Run `write_periodically` as a task on its own event loop in a daemon thread,
+        so snapshots are written whichever loop the checks run on.  Returns a function
+        that cancels the task, which writes a final snapshot.
+        """
+        import asyncio
+        import threading
+
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(self.write_periodically(filename, interval))
+
+        def _run():
+            try:
+                loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                pass
+            finally:
+                loop.close()
+
+        thread = threading.Thread(target=_run, name="weboptout-metrics", daemon=True)
+        thread.start()
+
+        def _stop():
+            loop.call_soon_threadsafe(task.cancel)
+            thread.join()
+        return _stop
+
+
+metrics = MetricsRegistry()
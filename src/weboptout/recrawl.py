@@ -0,0 +1,119 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import time
+import heapq
+import asyncio
+import collections
+
+from .types import rsv
+from .config import CHECK_DEADLINE
+from .client import ClientSession
+from .journal import Journal
+from .metrics import metrics
+from .utils import _resolve_path
+from .html import fingerprint_paragraphs
+from .http import _fetch_from_cache_or_network, _find_tos_links_from_url, _is_expired_failure
+from .web import _check_with_client
+
+
+__all__ = ["Fingerprint", "RecrawlResult", "schedule_recrawl", "recrawl_domains"]
+
+
+# State of a domain after it was last checked: the winning ToS page, hash of its
+# paragraphs, the reservation status and when it was checked, then the landing
+# page with the links to terms found on it, and the cache keys the check read.
+Fingerprint = collections.namedtuple(
+    'Fingerprint', ['url', 'digest', 'status', 'checked_at', 'home', 'links', 'keys'], defaults=(None, (), ())
+)
+
+RecrawlResult = collections.namedtuple('RecrawlResult', ['domain', 'previous', 'current', 'reclassified'])
+
+
+def schedule_recrawl(weights: dict, fingerprints: dict, limit: int = None, now: float = None) -> list:
+    """
+    Order domains by priority, the product of their weight and the time since they
+    were last checked, so domains never checked before come first.
+    """
+    now = time.time() if now is None else now
+
+    def _priority(domain):
+        if (fp := fingerprints.get(domain)) is None:
+            return float("inf")
+        return weights[domain] * (now - fp.checked_at)
+
+    if limit is None:
+        return sorted(weights, key=_priority, reverse=True)
+    return heapq.nlargest(limit, weights, key=_priority)
+
+
+def _is_recent_failure(result) -> bool:
+    return result is not None and result[-1] is None and not _is_expired_failure(result)
+
+
+async def _is_unchanged(client, previous: Fingerprint) -> bool:
+    # Fetch the landing page again to find out if the links to terms changed.
+    _fetch_from_cache_or_network.invalidate(previous.home)
+    _, links = await _find_tos_links_from_url(client, previous.home)
+    if links is None or tuple(links) != previous.links:
+        return False
+    if previous.digest is None:
+        return True
+
+    # Bypass the cache, keyed by the requested URL, as the page is the final one.
+    url, _, html = await _fetch_from_cache_or_network.__wrapped__(client, previous.url)
+    return bool(html) and (url, fingerprint_paragraphs(html)) == (previous.url, previous.digest)
+
+
+async def _recrawl_domain(domain: str, previous: Fingerprint, connector) -> tuple:
+    if previous is not None and previous.home is not None:
+        async with ClientSession(retention="none", connector=connector) as client:
+            if await _is_unchanged(client, previous):
+                metrics.increment("weboptout_recrawl_total", result="unchanged")
+                return previous._replace(checked_at=time.time()), False
+
+    # Fetch the pages the check read last time again rather than using the cache,
+    # except failures that expire with their own backoff.
+    if previous is not None:
+        for key in previous.keys or (previous.url, "https://" + domain):
+            if key is not None and not _is_recent_failure(_fetch_from_cache_or_network.cached(key)):
+                _fetch_from_cache_or_network.invalidate(key)
+
+    metrics.increment("weboptout_recrawl_total", result="reclassified")
+    async with ClientSession(retention="none", connector=connector, deadline=CHECK_DEADLINE) as client:
+        res = await _check_with_client(client, domain)
+
+    current = Fingerprint(res.url, None, rsv.get_name(res), time.time(), keys=tuple(dict.fromkeys(client._fetched)))
+    if res != rsv.ERROR and client._links is not None:
+        current = current._replace(home=client._links[0], links=client._links[1])
+        # The page that was classified, not fetched again, so the digest matches.
+        if res.url is not None and client._classified is not None:
+            current = current._replace(digest=fingerprint_paragraphs(client._classified[1]))
+    return current, True
+
+
+async def recrawl_domains(weights: dict, store: str = "cache/recrawl.pkl", jobs: int = 8, limit: int = None, connector=None):
+    """
+    Check domains again in order of priority, only classifying the Terms Of Service
+    if the paragraphs of the page found last time have changed.  The `weights` map
+    each domain to its importance, e.g. the number of images.  Yields a result per
+    domain with the previous and current fingerprints as each one completes.
+    """
+    journal = Journal(_resolve_path(store) if store.startswith("cache/") else store)
+    fingerprints = {k: Fingerprint(*v) for k, v in journal.load().items()}
+    semaphore = asyncio.Semaphore(jobs)
+
+    async def _check(domain):
+        async with semaphore:
+            previous = fingerprints.get(domain)
+            current, reclassified = await _recrawl_domain(domain, previous, connector)
+            journal.put(domain, tuple(current))
+            return RecrawlResult(domain, previous, current, reclassified)
+
+    tasks = [asyncio.ensure_future(_check(d)) for d in schedule_recrawl(weights, fingerprints, limit)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+        journal.close()
@@ -0,0 +1,167 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import re
+import json
+import time
+import asyncio
+import logging
+import collections
+
+import aiohttp
+from aiohttp import web
+
+from .types import rsv, Reservation
+from .bulk import reservation_to_dict
+from .metrics import metrics
+from .web import check_domain_reservation, normalize_host
+
+
+__all__ = ["ReservationService", "create_app"]
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReservationService:
+    """
+    State shared by all requests to the service: one connector for every check,
+    the results of recent checks, and the checks in flight so that identical
+    concurrent requests are coalesced into a single check.
+    """
+
+    def __init__(self, jobs: int = 32, ttl: float = 86400.0, capacity: int = 100_000, retention: str = "summary"):
+        self.jobs = jobs
+        self.ttl = ttl
+        self.capacity = capacity
+        self.retention = retention
+        self.connector = None
+        self.semaphore = None
+        self.results = collections.OrderedDict()
+        self.pending = {}
+
+    async def start(self, app=None):
+        # Created in the running loop, since Python 3.9 binds them on creation.
+        self.semaphore = asyncio.Semaphore(self.jobs)
+        self.connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=300)
+
+    async def close(self, app=None):
+        for future in self.pending.values():
+            future.cancel()
+        await self.connector.close()
+
+    @staticmethod
+    def normalize(source: str) -> str:
+        if re.match("^https?://", source, re.I):
+            return normalize_host(source)
+        return source.strip().lower().rstrip(".")
+
+    async def check(self, source: str) -> Reservation:
+        key = self.normalize(source)
+        if key == "":
+            return rsv.ERROR(url=None)
+
+        if (cached := self.results.get(key)) is not None and cached[0] > time.monotonic():
+            self.results.move_to_end(key)
+            metrics.increment("weboptout_service_total", result="cached")
+            return cached[1]
+
+        if (future := self.pending.get(key)) is not None:
+            metrics.increment("weboptout_service_total", result="coalesced")
+            return await asyncio.shield(future)
+
+        metrics.increment("weboptout_service_total", result="checked")
+        future = self.pending[key] = asyncio.ensure_future(self._check(key))
+        future.add_done_callback(lambda _: self.pending.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _check(self, domain: str) -> Reservation:
+        async with self.semaphore:
+            res = await check_domain_reservation(domain, retention=self.retention, connector=self.connector)
+
+        # Failed lookups are not kept, they may be temporary.
+        if res != rsv.ERROR:
+            self.results[domain] = (time.monotonic() + self.ttl, res)
+            while len(self.results) > self.capacity:
+                self.results.popitem(last=False)
+        return res
+
+
+def _to_json(source: str, res: Reservation, steps: bool) -> dict:
+    return {"source": source, **reservation_to_dict(res, steps=steps)}
+
+
+async def handle_check(request):
+    service, query = request.app["service"], request.query
+    if (source := query.get("url") or query.get("domain")) is None:
+        raise web.HTTPBadRequest(text="Expected a `domain` or `url` parameter.")
+
+    res = await service.check(source)
+    return web.json_response(_to_json(source, res, "steps" in query), dumps=lambda d: json.dumps(d, default=str))
+
+
+async def handle_batch(request):
+    """
+    Check many sources given as a JSON list or as one per line, and stream the
+    results as JSON lines in the order they complete.
+    """
+    service, steps = request.app["service"], "steps" in request.query
+    body = await request.text()
+    if body.lstrip().startswith("["):
+        try:
+            sources = json.loads(body)
+        except ValueError as exc:
+            raise web.HTTPBadRequest(text=f"Invalid JSON: {exc}")
+        if not all(isinstance(s, str) for s in sources):
+            raise web.HTTPBadRequest(text="Expected a JSON list of strings.")
+    else:
+        sources = [ln.strip() for ln in body.splitlines() if ln.strip()]
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+
+    async def _check(source):
+        # The response is already streaming, so failures are reported per source.
+        try:
+            return source, await service.check(source)
+        except Exception as exc:
+            metrics.increment("weboptout_check_errors_total", type=type(exc).__name__)
+            logger.warning("%s: %s %s", source, type(exc).__name__, exc)
+            return source, rsv.ERROR(url=None)
+
+    for task in asyncio.as_completed([_check(s) for s in sources]):
+        source, res = await task
+        await response.write((json.dumps(_to_json(source, res, steps), default=str) + "\n").encode())
+
+    await response.write_eof()
+    return response
+
+
+async def handle_health(request):
+    service = request.app["service"]
+    return web.json_response({
+        "status": "ok",
+        "uptime": time.monotonic() - metrics.started,
+        "pending": len(service.pending),
+        "cached": len(service.results),
+    })
+
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.to_prometheus(), content_type="text/plain")
+
+
+def create_app(**options) -> web.Application:
+    """
+    Create the web application of the service, with options for the shared
+    ReservationService such as the number of concurrent `jobs`.
+    """
+    app = web.Application()
+    app["service"] = service = ReservationService(**options)
+    app.on_startup.append(service.start)
+    app.on_cleanup.append(service.close)
+
+    app.router.add_get("/check", handle_check)
+    app.router.add_post("/batch", handle_batch)
+    app.router.add_get("/health", handle_health)
+    app.router.add_get("/metrics", handle_metrics)
+    return app
@@ -0,0 +1,104 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import os
+import json
+import shutil
+import hashlib
+import collections
+
+
+__all__ = ["registrable_domain", "shard_of", "select_shard", "merge_results", "merge_caches"]
+
+
+# Second-level labels under country codes where domains are registered, as in
+# `example.co.uk`, which is enough to keep related hosts on the same shard.
+SECOND_LEVEL_LABELS = {"co", "com", "net", "org", "ac", "gov", "edu", "ne", "or", "go", "gob", "nic"}
+
+
+def registrable_domain(host: str) -> str:
+    """
+    Approximate the domain that was registered for a host, which is the last two
+    labels, or three when the second-to-last is a common second-level label.
+    """
+    labels = host.lower().rstrip(".").split(".")
+    if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in SECOND_LEVEL_LABELS:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+
+def shard_of(source: str, count: int) -> int:
+    """
+    Stable shard index of a domain or URL, the same on every machine, so that all
+    the parent domains tried for a host are cached by the same shard.
+    """
+    from .web import normalize_host
+
+    host = normalize_host(source) if "://" in source else source.strip()
+    digest = hashlib.md5(registrable_domain(host).encode()).digest()
+    return int.from_bytes(digest[:8], "little") % count
+
+
+def select_shard(sources, index: int, count: int):
+    """
+    Filter an iterable of sources to keep only those in the given shard.
+    """
+    assert 0 <= index < count, f"Shard {index} out of range for {count} shards."
+    for source in sources:
+        if (source := source.strip()) and not source.startswith("#") and shard_of(source, count) == index:
+            yield source
+
+
+def merge_results(filenames: list, output) -> collections.Counter:
+    """
+    Concatenate the JSON lines written by `batch` for each shard into one output,
+    line by line so memory doesn't grow with the number of results, and return
+    the number of results per status.  Sources are only ever in one shard, so
+    there are no duplicates to remove.
+    """
+    counts = collections.Counter()
+    for filename in filenames:
+        with open(filename, 'r') as f:
+            for line in f:
+                if line.strip():
+                    counts[json.loads(line)["status"]] += 1
+                    output.write(line.rstrip("\n") + "\n")
+    return counts
+
+
+def merge_caches(directories: list, target: str) -> int:
+    """
+    Merge the cache directories of each shard into the target cache with the same
+    rules as importing a snapshot: pages are kept if more recent and never replaced
+    by failures, and the entries of journals are merged one by one.  Other files
+    are copied if more recent.  Returns the number of entries merged.
+    """
+    from .journal import Journal
+    from .snapshot import _find_journals, _import_page, _import_journal, _last_modified
+
+    merged = 0
+    for directory in directories:
+        journals = _find_journals(directory)
+        for name in journals:
+            journal = Journal(os.path.join(directory, name))
+            state, times = journal.read()
+            mtime = _last_modified(journal)
+            merged += _import_journal(os.path.join(target, name), state, {k: times.get(k) or mtime for k in state})
+
+        skipped = {f"{name}{suffix}" for name in journals for suffix in ("", ".journal", ".lock", ".tmp")}
+        for root, _, files in os.walk(directory):
+            for name in files:
+                source = os.path.join(root, name)
+                relative = os.path.relpath(source, directory)
+                dest = os.path.join(target, relative)
+                if relative in skipped:
+                    continue
+                if relative.startswith("www" + os.sep) and name.endswith(".pkl"):
+                    with open(source, 'rb') as f:
+                        merged += _import_page(dest, f.read(), os.path.getmtime(source))
+                    continue
+                if os.path.isfile(dest) and os.path.getmtime(dest) >= os.path.getmtime(source):
+                    continue
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy2(source, dest)
+                merged += 1
+    return merged
@@ -0,0 +1,202 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import io
+import os
+import json
+import time
+import pickle
+import tarfile
+import collections
+
+from . import __version__
+from .journal import Journal
+
+
+__all__ = ["export_cache", "import_cache"]
+
+
+# Archives are tar.gz files that start with a manifest, followed by the pickles of
+# the page cache in `www/` and the state of each journal in `journals/` with the
+# time each entry changed, or only the state in the first version.
+FORMAT = "weboptout-cache"
+VERSION = 2
+
+
+def _host(key: str) -> str:
+    from .web import normalize_host
+
+    return normalize_host(key) if "://" in key else key.lower().rstrip(".")
+
+
+def _matches_domains(key: str, domains: set) -> bool:
+    host = _host(key)
+    return any(host == d or host.endswith("." + d) for d in domains)
+
+
+def _is_failure(result: tuple) -> bool:
+    return result[-1] is None
+
+
+def _find_journals(directory: str) -> list:
+    """
+    Base filenames of the journals stored in the cache, relative to its root.
+    """
+    names = set()
+    for root, _, files in os.walk(directory):
+        for name in files:
+            for suffix in (".journal", ".lock"):
+                if name.endswith(suffix):
+                    names.add(os.path.relpath(os.path.join(root, name[:-len(suffix)]), directory))
+    return sorted(names)
+
+
+def _last_modified(journal: Journal) -> float:
+    # Used for entries written by older versions, which have no time of their own.
+    return max((os.path.getmtime(f) for f in (journal.filename, journal.journal) if os.path.isfile(f)), default=0.0)
+
+
+def _add_file(tar, name: str, data: bytes, mtime: float):
+    info = tarfile.TarInfo(name)
+    info.size, info.mtime = len(data), mtime
+    tar.addfile(info, io.BytesIO(data))
+
+
+def export_cache(target: str, directory: str, domains: set = None, max_age: float = None) -> collections.Counter:
+    """
+    Pack the page cache and the journals of results in the cache directory into
+    a compressed archive, optionally only for hosts within the given domains and
+    entries more recent than `max_age` seconds.  Failed fetches that already
+    expired are skipped.  Returns the number of entries exported per kind.
+    """
+    from .http import _is_expired_failure
+
+    now, counts = time.time(), collections.Counter()
+    manifest = {
+        "format": FORMAT, "version": VERSION, "created": now, "weboptout": __version__,
+        "domains": sorted(domains) if domains is not None else None, "max_age": max_age,
+    }
+
+    with tarfile.open(target + ".tmp", 'w:gz') as tar:
+        _add_file(tar, "manifest.json", json.dumps(manifest).encode(), now)
+
+        pages = os.path.join(directory, "www")
+        for name in sorted(os.listdir(pages)) if os.path.isdir(pages) else []:
+            filename = os.path.join(pages, name)
+            if not name.endswith(".pkl") or (max_age is not None and os.path.getmtime(filename) < now - max_age):
+                continue
+            with open(filename, 'rb') as f:
+                data = f.read()
+            result = pickle.loads(data)
+            if _is_expired_failure(result) or (domains is not None and not _matches_domains(result[0], domains)):
+                continue
+            _add_file(tar, f"www/{name}", data, os.path.getmtime(filename))
+            counts["failures" if _is_failure(result) else "pages"] += 1
+
+        for name in _find_journals(directory):
+            journal = Journal(os.path.join(directory, name))
+            mtime = _last_modified(journal)
+            # Reading never compacts, so the source cache is left as it was.
+            state, times = journal.read()
+            times = {k: times.get(k) or mtime for k in state}
+            state = {
+                k: v for k, v in state.items()
+                if (max_age is None or times[k] >= now - max_age)
+                and (domains is None or _matches_domains(str(k), domains))
+            }
+            if not state:
+                continue
+            _add_file(tar, f"journals/{name}", pickle.dumps((state, {k: times[k] for k in state})), mtime)
+            counts["results"] += len(state)
+
+    os.replace(target + ".tmp", target)
+    return counts
+
+
+def _is_safe_name(name: str) -> bool:
+    return not os.path.isabs(name) and ".." not in name.split("/")
+
+
+def _import_page(path: str, data: bytes, mtime: float) -> bool:
+    """
+    Store a cached page unless the local one is more recent, except that pages
+    always replace failed fetches and are never replaced by them.
+    """
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            local = pickle.load(f)
+        imported = pickle.loads(data)
+        if _is_failure(local) != _is_failure(imported):
+            if _is_failure(imported):
+                return False
+        elif os.path.getmtime(path) >= mtime:
+            return False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", 'wb') as f:
+        f.write(data)
+    os.utime(path + ".tmp", (mtime, mtime))
+    os.replace(path + ".tmp", path)
+    return True
+
+
+def _import_journal(path: str, state: dict, times: dict) -> int:
+    """
+    Store the entries that are missing locally or more recent than the local ones,
+    keeping the time they changed, unless they're identical.
+    """
+    journal = Journal(path)
+    local, local_times = journal.read()
+    mtime = _last_modified(journal)
+
+    imported = 0
+    try:
+        for key, value in state.items():
+            if key in local:
+                if (local_times.get(key) or mtime) >= times[key]:
+                    continue
+                if pickle.dumps(local[key]) == pickle.dumps(value):
+                    continue
+            journal.put(key, value, changed=times[key])
+            imported += 1
+    finally:
+        journal.close()
+    return imported
+
+
+def import_cache(source, directory: str) -> collections.Counter:
+    """
+    Merge an archive written by `export_cache` into the cache directory, keeping
+    local entries that are more recent.  The source is a filename or a file object
+    that is read as a stream.  Archives contain pickles so they must be trusted.
+    Returns the number of entries imported and skipped.
+    """
+    counts = collections.Counter()
+    kwargs = {"name": source} if isinstance(source, str) else {"fileobj": source}
+
+    with tarfile.open(mode='r|gz', **kwargs) as tar:
+        manifest = None
+        for member in tar:
+            data = tar.extractfile(member).read() if member.isfile() else None
+            if manifest is None:
+                assert member.name == "manifest.json", "Expected a manifest at the start of the archive."
+                manifest = json.loads(data)
+                assert manifest["format"] == FORMAT, "Not a cache archive."
+                assert manifest["version"] <= VERSION, f"Unsupported cache archive version {manifest['version']}."
+                continue
+
+            assert data is not None and _is_safe_name(member.name), f"Unexpected file {member.name} in archive."
+            kind, _, name = member.name.partition("/")
+            if kind == "www":
+                imported = _import_page(os.path.join(directory, "www", name), data, member.mtime)
+                counts["pages imported" if imported else "pages skipped"] += 1
+            elif kind == "journals":
+                state = pickle.loads(data)
+                if manifest["version"] >= 2:
+                    state, times = state
+                else:
+                    times = {k: member.mtime for k in state}
+                imported = _import_journal(os.path.join(directory, name), state, times)
+                counts["results imported"] += imported
+                counts["results skipped"] += len(state) - imported
+
+    return counts
@@ -2,7 +2,6 @@
 
 import os
 import re
-import json
 import atexit
 import pickle
 import asyncio
@@ -11,9 +10,12 @@ import fnmatch
 import hashlib
 import inspect
 import collections
-import pkg_resources
+import importlib.resources
 
 from .types import Reservation
+from .journal import Journal
+from .database import load_database
+from .metrics import metrics
 
 
 __all__ = [
@@ -31,12 +33,12 @@ def allow_sync_calls(fn):
     def _wrapper(*args, **kwargs):
         loop = asyncio._get_running_loop()
         if loop is not None:
-            return fn(*args)
+            return fn(*args, **kwargs)
 
         loop = asyncio.new_event_loop()
         atexit.register(loop.close)
 
-        return loop.run_until_complete(fn(*args))
+        return loop.run_until_complete(fn(*args, **kwargs))
     return _wrapper
 
 
@@ -44,11 +46,12 @@ def limit_concurrency(value: int):
     """
     Decorator to prevent an async function from being called more than N times.
     """
-    def _decorator(fn, __semaphore__: list = []):
+    def _decorator(fn):
+        __semaphore__ = []
+
         async def _wrapper(*args, **kwargs):
             if len(__semaphore__) == 0:
-                loop = asyncio._get_running_loop()
-                __semaphore__.append(asyncio.Semaphore(value, loop=loop))
+                __semaphore__.append(asyncio.Semaphore(value))
 
             async with __semaphore__[0]:
                 return await fn(*args, **kwargs)
@@ -57,13 +60,29 @@ def limit_concurrency(value: int):
     return _decorator
 
 
-def cache_to_directory(directory, /, key: str, filter: callable = None):
+def _resolve_path(path: str) -> str:
+    """
+    Find a file relative to the installed package, or relative to the root of the
+    repository when running from a source checkout.  Paths within `cache/` can be
+    moved elsewhere with the WEBOPTOUT_CACHE environment variable.
+    """
+    if path.startswith("cache/") and os.environ.get("WEBOPTOUT_CACHE"):
+        return os.path.join(os.environ["WEBOPTOUT_CACHE"], path[len("cache/"):])
+
+    full_path = str(importlib.resources.files(__package__).joinpath(path))
+    return full_path.replace('src/weboptout/', '')
+
+
+def cache_to_directory(directory, /, key: str, filter: callable = None, merge: callable = None):
     """
     Decorator to cache results of a function to individual pickle files on disk.
+    The directory is only resolved on the first call, and created when the first
+    result is stored.  When the `filter` rejects a cached result, the new result
+    can be combined with it by `merge(previous, result)` before it's stored.  The
+    cached result for a key is read with `fn.cached(key)`, or None if there's none,
+    and removed with `fn.invalidate(key)`.
     """
-    full_path = pkg_resources.resource_filename(__name__, directory)
-    full_path = full_path.replace('src/weboptout/', '')
-    os.makedirs(full_path, exist_ok=True)
+    full_path = None
 
     def _decorator(fn):        
         arg_names = list(inspect.signature(fn).parameters.keys())
@@ -72,35 +91,63 @@ def cache_to_directory(directory, /, key: str, filter: callable = None):
         assert inspect.iscoroutinefunction(fn), \
             "Synchronous functions not supported by cache_to_directory."
 
+        def _filename(k: str) -> str:
+            nonlocal full_path
+            if full_path is None:
+                full_path = _resolve_path(directory)
+            return f'{full_path}/{hashlib.md5(k.encode()).hexdigest()}.pkl'
+
+        def _cached(k: str):
+            try:
+                with open(_filename(k), 'rb') as f:
+                    return pickle.load(f)
+            except FileNotFoundError:
+                return None
+
+        def _invalidate(k: str):
+            try:
+                os.remove(_filename(k))
+            except FileNotFoundError:
+                pass
+
         async def _wrapper(*args, **kwargs):
-            hex = hashlib.md5(args[arg_idx].encode()).hexdigest()
-            filename = f'{full_path}/{hex}.pkl'
+            filename, previous = _filename(args[arg_idx]), None
             if os.path.isfile(filename):
                 result = pickle.load(open(filename, 'rb'))
-                if filter is None or not filter(*args, filename=f'{directory}/{hex}.pkl', result=result):
+                if filter is None or not filter(*args, filename=f'{directory}/{os.path.basename(filename)}', result=result):
+                    metrics.increment("weboptout_cache_total", tier=directory, result="hit")
                     return result
+                metrics.increment("weboptout_cache_total", tier=directory, result="rejected")
+                previous = result
+            else:
+                metrics.increment("weboptout_cache_total", tier=directory, result="miss")
 
             result = await fn(*args, **kwargs)
-            pickle.dump(result, open(filename, 'wb'))
+            if merge is not None and previous is not None:
+                result = merge(previous, result)
+            try:
+                os.makedirs(full_path, exist_ok=True)
+                with open(filename, 'wb') as f:
+                    pickle.dump(result, f)
+            except OSError:
+                # Read-only or full filesystem, the result is still returned.
+                pass
             return result
 
         _wrapper.__wrapped__ = fn
+        _wrapper.cached = _cached
+        _wrapper.invalidate = _invalidate
         return _wrapper
     return _decorator
 
 
 def retrieve_from_database(archive, /, key: str, filter: callable = None):
-    Entry = collections.namedtuple('Entry', ['pattern', 'url'])
-
-    archive = pkg_resources.resource_filename(__name__, archive)
-    archive = archive.replace('src/weboptout/', '')
-
-    if os.path.isfile(archive):
-        with open(archive, 'r') as f:
-            assert f.readline().startswith("## Copyright")
-            database = [Entry(*json.loads(e)) for e in f.readlines()]
-    else:
-        database = []
+    """
+    Decorator to look up results in a packaged database of patterns, which is
+    only loaded from disk the first time the function is called.
+    """
+    archive = _resolve_path(archive)
+    database = None
 
     def _decorator(fn):
         arg_names = list(inspect.signature(fn).parameters.keys())
@@ -110,13 +157,17 @@ def retrieve_from_database(archive, /, key: str, filter: callable = None):
             "Synchronous functions not supported by retrieve_from_database."
 
         async def _wrapper(*args, **kwargs):
+            nonlocal database
+            if database is None:
+                database = load_database(archive)
+
             k = args[arg_idx].replace('https://', '')
-            for entry in database:
-                if not fnmatch.fnmatch(k, entry.pattern):
-                    continue
+            for entry in database.matches(k):
                 if filter is None or not filter(*args, result=result):
+                    metrics.increment("weboptout_cache_total", tier=os.path.basename(archive), result="hit")
                     return args[arg_idx], [entry.url]
 
+            metrics.increment("weboptout_cache_total", tier=os.path.basename(archive), result="miss")
             result = await fn(*args, **kwargs)
             return result
 
@@ -171,42 +222,50 @@ def extract_common_pattern(A, B):
 
 
 def retrieve_result_from_cache(archive, /, key: str, filter: callable = None):
-    archive = pkg_resources.resource_filename(__name__, archive)
-    archive = archive.replace('src/weboptout/', '')
-    os.makedirs(os.path.dirname(archive), exist_ok=True)
-
-    if os.path.isfile(archive):
-        lookup = {
-            k: Reservation(v[0], v[1], v[2], v[3])
-            for k, v in pickle.load(open(archive, 'rb')).items()
-        }
-    else:
-        lookup = {}
+    """
+    Decorator to look up results in a database of patterns that is built as the
+    function is called.  Every change is appended to a journal next to the archive
+    so nothing is lost if the process exits abnormally.
+    """
+    archive = _resolve_path(archive)
+    journal = Journal(archive)
+    lookup, loaded = {}, False
+    # Keys of the lookup for each URL, in insertion order, so that new keys are
+    # only compared with those sharing the same URL.
+    by_url = collections.defaultdict(dict)
+
+    def _load_from_disk():
+        for k, v in journal.load().items():
+            _assign(k, Reservation(v[0], v[1], v[2], v[3]), persist=False)
+        atexit.register(journal.close)
+
+    def _assign(key, r, persist=True):
+        if key in lookup:
+            by_url[lookup[key].url].pop(key, None)
+        lookup[key] = r
+        by_url[r.url][key] = None
+        if persist:
+            journal.put(key, (r._id, r.url, r.process, r.outcome))
+
+    def _remove(key):
+        by_url[lookup.pop(key).url].pop(key)
+        journal.delete(key)
 
     def _add_to_database(key, r):
         if r.url is None:
             return
 
-        options = []
-        for match in [(k, v) for k, v in lookup.items() if v.url == r.url]:        
-            pat = extract_common_pattern(key, match[0])
+        for match in list(by_url[r.url]):
+            pat = extract_common_pattern(key, match)
             if pat is None:
                 continue
-            options.append((pat, match))
 
-        if len(options) > 0:
-            pat, match = options[0]
-            lookup[pat] = r
-            del lookup[match[0]]
+            _assign(pat, r)
+            if match != pat:
+                _remove(match)
+            break
         else:
-            lookup[key] = r
-
-    def _dump_to_disk():
-        pickle.dump(
-            {k: (v._id, v.url, v.process, v.outcome) for k, v in lookup.items()},
-            open(archive, 'wb')
-        )
-    atexit.register(_dump_to_disk)
+            _assign(key, r)
 
     def _decorator(fn):
         arg_names = list(inspect.signature(fn).parameters.keys())
@@ -216,13 +275,20 @@ def retrieve_result_from_cache(archive, /, key: str, filter: callable = None):
             "Synchronous functions not supported by cache_to_directory."
 
         async def _wrapper(*args, **kwargs):
+            nonlocal loaded
+            if not loaded:
+                _load_from_disk()
+                loaded = True
+
             k = args[arg_idx]
             for pattern, result in lookup.items():
                 if not fnmatch.fnmatch(k, pattern):
                     continue
                 if filter is None or not filter(*args, result=result):
+                    metrics.increment("weboptout_cache_total", tier=os.path.basename(archive), result="hit")
                     return result
 
+            metrics.increment("weboptout_cache_total", tier=os.path.basename(archive), result="miss")
             result = await fn(*args, **kwargs)
             _add_to_database(k, result)
             return result
@@ -1,10 +1,13 @@
 ## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
 
-from urllib.parse import urlparse
+import time
+from urllib.parse import urlsplit
 
 from .types import rsv, Reservation, Status
-from .client import ClientSession
+from .config import CHECK_DEADLINE
+from .client import ClientSession, DeadlineExceeded
 from .utils import allow_sync_calls
+from .metrics import metrics
 from .http import search_tos_for_domain
 from .html import check_tos_reservation
 
@@ -13,36 +16,75 @@ __all__ = ["check_domain_reservation"]
 
 
 @allow_sync_calls
-async def check_domain_reservation(domain: str) -> Reservation:
+async def check_domain_reservation(domain: str, retention: str = "full", connector=None, deadline: float = CHECK_DEADLINE) -> Reservation:
+    """
+    Check if the domain has a reservation of rights in its Terms Of Service.  The
+    `retention` level of the step log is either "full", "summary" to truncate large
+    values in the context, or "none" to skip the log and keep only the outcome.
+    An aiohttp `connector` can be shared between many checks to reuse connections.
+    The check gives up with an error after `deadline` seconds, or never if None.
+    """
+    started = time.monotonic()
+    result = await _check_domain_reservation(domain, retention, connector, deadline)
+    metrics.observe("weboptout_check_seconds", time.monotonic() - started, result=rsv.get_name(result))
+    return result
+
+
+async def _check_domain_reservation(domain: str, retention: str, connector, deadline: float) -> Reservation:
     assert not any(domain.startswith(k) for k in ("https://", "http://"))
 
-    async with ClientSession() as client:
-        async for url, tos, options in search_tos_for_domain(client, domain):
-            # No TOS found but at least the server worked.
-            if tos == "":
-                return rsv.MAYBE(url=url, process=client._steps, outcome=client._output)
+    async with ClientSession(retention=retention, connector=connector, deadline=deadline) as client:
+        return await _check_with_client(client, domain)
+
+
+async def _check_with_client(client, domain: str) -> Reservation:
+    try:
+        # Stages check the deadline themselves, this is only a backstop.
+        return await client.within_deadline(_search_and_classify(client, domain))
+    except DeadlineExceeded:
+        return rsv.ERROR(url=None, process=client._steps, outcome=client._output)
 
-            status = check_tos_reservation(client, url, tos)
 
-            # Need to fetch the content again with webdriver?
-            if status == Status.RETRY:
-                options.retry = True
-                continue
+async def _search_and_classify(client, domain: str) -> Reservation:
+    async for url, tos, options in search_tos_for_domain(client, domain):
+        # No TOS found but at least the server worked.
+        if tos == "":
+            return rsv.MAYBE(url=url, process=client._steps, outcome=client._output)
 
-            # Wrong place or wrong language from website...
-            if status == Status.ABORT:
-                return rsv.MAYBE(url=url, process=client._steps, outcome=client._output)
+        client._classified = (url, tos)
+        status = check_tos_reservation(client, url, tos)
 
-            # Not enough text or not enough legal content.
-            if status == Status.FAILURE:
-                continue
+        # Need to fetch the content again with webdriver?
+        if status == Status.RETRY:
+            options.retry = True
+            continue
 
-            return rsv.YES(url=url, process=client._steps, outcome=client._output)
+        # Wrong place or wrong language from website...
+        if status == Status.ABORT:
+            return rsv.MAYBE(url=url, process=client._steps, outcome=client._output)
+
+        # Not enough text or not enough legal content.
+        if status == Status.FAILURE:
+            continue
+
+        return rsv.YES(url=url, process=client._steps, outcome=client._output)
 
     # This happens when none of the domains can be looked up.
     return rsv.ERROR(url=None, process=client._steps, outcome=client._output)
 
 
-def check_url_reservation(url: str) -> Reservation:
-    domain = urlparse(url).netloc
-    return check_domain_reservation(domain)
+def normalize_host(url: str) -> str:
+    """
+    Extract the host of a URL in the form used to check domains: lowercase, without
+    credentials, trailing dot or default port.
+    """
+    host = urlsplit(url.strip()).netloc.rpartition("@")[2].lower()
+    for port in (":443", ":80"):
+        if host.endswith(port):
+            host = host[:-len(port)]
+    return host.rstrip(".")
+
+
+def check_url_reservation(url: str, retention: str = "full", connector=None, deadline: float = CHECK_DEADLINE) -> Reservation:
+    domain = normalize_host(url)
+    return check_domain_reservation(domain, retention=retention, connector=connector, deadline=deadline)
@@ -0,0 +1,48 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import io
+import collections
+
+from hypothesis import given, settings, strategies as st
+
+from weboptout.aggregate import SpaceSaving, top_domains, read_domain_counts
+
+
+_streams = st.lists(st.tuples(st.integers(0, 30), st.integers(1, 20)), max_size=300)
+
+
+@settings(max_examples=300)
+@given(stream=_streams, capacity=st.integers(1, 12))
+def test_space_saving_error_bounds(stream, capacity):
+    counts, exact = SpaceSaving(capacity), collections.Counter()
+    for key, count in stream:
+        counts.add(key, count)
+        exact[key] += count
+
+    total = sum(exact.values())
+    assert len(counts.counts) <= capacity
+    assert sum(counts.counts.values()) == total
+
+    for key, estimate in counts.items():
+        # Overestimated by at most the recorded error, which is below the minimum.
+        assert exact[key] <= estimate <= exact[key] + counts.errors[key]
+        assert counts.errors[key] <= min(counts.counts.values())
+
+    # Keys heavier than the total divided by the capacity are always kept.
+    for key, count in exact.items():
+        if count > total / capacity:
+            assert key in counts.counts
+
+
+@settings(max_examples=100)
+@given(stream=_streams, k=st.integers(1, 5))
+def test_top_domains_exact_with_enough_capacity(stream, k):
+    lines = [f"d{key}.com\t{count}\n" for key, count in stream]
+    exact = top_domains([lines], k)
+    approximate = top_domains([lines], k, capacity=len({key for key, _ in stream}) + k)
+    assert sorted(c for _, c in approximate) == sorted(c for _, c in exact)
+
+
+def test_read_domain_counts_formats():
+    lines = io.StringIO("# comment\nexample.com\t1,234.0\n\nbad-line\nother.com\t5\n")
+    assert list(read_domain_counts([lines])) == [("example.com", 1234), ("other.com", 5)]
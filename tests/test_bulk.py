@@ -0,0 +1,94 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import asyncio
+import collections
+
+import pytest
+
+import weboptout.web
+from weboptout import rsv
+from weboptout.bulk import check_sources_in_bulk, check_urls_in_bulk
+
+
+class FakeChecks:
+    """
+    Replaces the checks of domains with results from a table, counting the calls
+    and optionally delaying some domains so they finish out of order.
+    """
+
+    def __init__(self, results: dict, delays: dict = None):
+        self.results, self.delays = results, delays or {}
+        self.calls = collections.Counter()
+
+    async def __call__(self, domain, **options):
+        self.calls[domain] += 1
+        await asyncio.sleep(self.delays.get(domain, 0.0))
+        return self.results.get(domain, rsv.ERROR)(url=f"https://{domain}/terms")
+
+
+@pytest.fixture
+def checks(monkeypatch):
+    fake = FakeChecks({"yes.com": rsv.YES, "maybe.com": rsv.MAYBE, "error.com": rsv.ERROR})
+    monkeypatch.setattr(weboptout.web, "check_domain_reservation", fake)
+    return fake
+
+
+async def _collect(iterator):
+    return [(source, rsv.get_name(res)) async for source, res in iterator]
+
+
+def test_sources_resume_from_manifest_and_retry_errors(checks, tmp_path):
+    manifest, sources = str(tmp_path / "run.manifest"), ["yes.com", "# comment", "maybe.com", "error.com", ""]
+
+    first = asyncio.run(_collect(check_sources_in_bulk(sources, jobs=2, manifest=manifest)))
+    assert sorted(first) == [("error.com", "ERROR"), ("maybe.com", "MAYBE"), ("yes.com", "YES")]
+
+    second = asyncio.run(_collect(check_sources_in_bulk(sources, jobs=2, manifest=manifest)))
+    assert sorted(second) == sorted(first)
+    assert checks.calls == {"yes.com": 1, "maybe.com": 1, "error.com": 2}
+
+
+def test_urls_resume_per_host_and_retry_errors(checks, tmp_path):
+    manifest = str(tmp_path / "urls.manifest")
+    urls = [f"https://{host}/{i}.jpg" for i in range(3) for host in ("yes.com", "error.com")]
+
+    # Interrupted after the first URLs, which only finished some of the hosts.
+    async def _interrupted():
+        iterator = check_urls_in_bulk(urls, jobs=2, manifest=manifest)
+        first = [await iterator.__anext__() for _ in range(2)]
+        await iterator.aclose()
+        return first
+
+    asyncio.run(_interrupted())
+    assert checks.calls == {"yes.com": 1, "error.com": 1}
+
+    results = asyncio.run(_collect(check_urls_in_bulk(urls, jobs=2, manifest=manifest)))
+    assert [url for url, _ in results] == urls
+    assert checks.calls == {"yes.com": 1, "error.com": 2}
+
+
+def test_urls_check_each_host_once_in_input_order(monkeypatch):
+    # The first host is the slowest, so later results wait for it to keep the order.
+    fake = FakeChecks({"slow.com": rsv.YES, "fast.com": rsv.MAYBE}, delays={"slow.com": 0.05})
+    monkeypatch.setattr(weboptout.web, "check_domain_reservation", fake)
+    urls = [
+        "https://slow.com/1.jpg", "https://FAST.com:443/2.jpg", "# comment", "https://slow.com./3.jpg",
+        "fast.com", "http:///missing-host", "https://fast.com/4.jpg",
+    ]
+
+    results = asyncio.run(_collect(check_urls_in_bulk(urls, jobs=2, window=3)))
+    assert results == [
+        ("https://slow.com/1.jpg", "YES"), ("https://FAST.com:443/2.jpg", "MAYBE"), ("https://slow.com./3.jpg", "YES"),
+        ("fast.com", "MAYBE"), ("http:///missing-host", "ERROR"), ("https://fast.com/4.jpg", "MAYBE"),
+    ]
+    assert fake.calls == {"slow.com": 1, "fast.com": 1}
+
+
+def test_urls_from_async_iterable(checks):
+    async def _urls():
+        for host in ("yes.com", "maybe.com", "yes.com"):
+            yield f"https://{host}/image.jpg"
+
+    results = asyncio.run(_collect(check_urls_in_bulk(_urls())))
+    assert [status for _, status in results] == ["YES", "MAYBE", "YES"]
+    assert checks.calls == {"yes.com": 1, "maybe.com": 1}
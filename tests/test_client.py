@@ -0,0 +1,66 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import asyncio
+
+import pytest
+
+import weboptout.web
+from weboptout import rsv
+from weboptout.steps import Steps
+from weboptout.config import HOST_TIMEOUT_DEFAULT, HOST_TIMEOUT_FACTOR, HOST_TIMEOUT_MIN
+from weboptout.client import ClientSession, DeadlineExceeded, HostLatency
+
+
+async def _timeout():
+    raise asyncio.TimeoutError()
+
+
+def test_host_latency_backs_off_after_timeouts():
+    latency = HostLatency()
+    latency.observe("slow.com", 2.0)
+    assert latency.timeout("slow.com") == HOST_TIMEOUT_FACTOR * 2.0
+
+    budgets = []
+    for _ in range(3):
+        latency.observe_timeout("slow.com")
+        budgets.append(latency.timeout("slow.com"))
+    assert budgets == [max(HOST_TIMEOUT_FACTOR * 2.0 / 2 ** i, HOST_TIMEOUT_MIN) for i in range(1, 4)]
+
+    latency.observe_timeout("dead.com")
+    assert latency.timeout("dead.com") == HOST_TIMEOUT_DEFAULT / 2
+
+    # Responding again resets the backoff.
+    latency.observe("slow.com", 2.0)
+    assert latency.timeout("slow.com") == HOST_TIMEOUT_FACTOR * 2.0
+
+
+@pytest.mark.parametrize("deadline", [None, 60.0])
+def test_timeout_of_stage_stops_check(deadline):
+    async def _run():
+        async with ClientSession(deadline=deadline) as client:
+            with pytest.raises(DeadlineExceeded) as exc:
+                await client.within_deadline(_timeout(), Steps.RetrievePage, url="https://example.com")
+            return exc.value.step, client._steps[-1]
+
+    step, record = asyncio.run(_run())
+    assert step == record.step == Steps.RetrievePage
+    assert record.context == {"timeout": True, "url": "https://example.com"}
+
+
+def test_deadline_reports_step_that_started():
+    async def _run():
+        async with ClientSession(deadline=0.05) as client:
+            client.check_deadline(Steps.RetrieveContent)
+            with pytest.raises(DeadlineExceeded) as exc:
+                await client.within_deadline(asyncio.sleep(1.0))
+            return exc.value.step
+
+    assert asyncio.run(_run()) == Steps.RetrieveContent
+
+
+def test_check_returns_error_when_stage_times_out(monkeypatch):
+    async def _search_and_classify(client, domain):
+        await client.within_deadline(_timeout(), Steps.RetrievePage)
+
+    monkeypatch.setattr(weboptout.web, "_search_and_classify", _search_and_classify)
+    assert weboptout.web.check_domain_reservation("example.com") == rsv.ERROR
@@ -0,0 +1,148 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import os
+import json
+
+import pytest
+from hypothesis import given, settings, HealthCheck, strategies as st
+
+from weboptout.database import JsonDatabase, CompiledDatabase, InvalidDatabase, compile_database, load_database
+from weboptout.database import build_database, generalize_hosts
+import weboptout.database
+
+
+ENTRIES = [
+    ["example.com", "https://example.com/terms"],
+    ["*.example.com", "https://example.com/legal"],
+    ["cdn*.example.com", "https://cdn.example.com/tos"],
+    ["shop.example.co.uk", "https://shop.example.co.uk/terms"],
+    ["*.co.uk", "https://registry.co.uk/terms"],
+    ["img?.static.net", "https://static.net/terms"],
+    ["[ab]pi.service.io", "https://service.io/terms"],
+    ["*", "https://fallback.org/terms"],
+    ["example.com", "https://example.com/duplicate"],
+]
+
+KEYS = [
+    "example.com", "www.example.com", "cdn1.example.com", "a.b.example.com", "shop.example.co.uk",
+    "other.co.uk", "img1.static.net", "img12.static.net", "api.service.io", "cpi.service.io",
+    "unknown.org", "com", "",
+]
+
+
+def _write_source(filename, entries=ENTRIES):
+    with open(filename, 'w') as f:
+        f.write("## Copyright\n")
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+
+
+@pytest.fixture
+def source(tmp_path):
+    filename = str(tmp_path / "tos.jsonl")
+    _write_source(filename)
+    return filename
+
+
+def test_compiled_matches_equal_json(source, tmp_path):
+    target = str(tmp_path / "tos.idx")
+    assert compile_database(source, target) == len(ENTRIES)
+
+    json_db, compiled_db = JsonDatabase(source), CompiledDatabase(target)
+    for key in KEYS:
+        assert list(compiled_db.matches(key)) == list(json_db.matches(key)), key
+
+
+_labels = st.sampled_from(["a", "b", "ab", "cdn1", "cdn2", "com", "www"])
+_hosts = st.lists(_labels, min_size=1, max_size=4).map(".".join)
+_patterns = st.lists(st.one_of(_labels, st.sampled_from(["*", "a*", "?b", "[ab]"])), min_size=1, max_size=4).map(".".join)
+
+
+@settings(max_examples=50, suppress_health_check=[HealthCheck.function_scoped_fixture])
+@given(patterns=st.lists(_patterns, max_size=12), keys=st.lists(_hosts, min_size=1, max_size=8))
+def test_compiled_matches_equal_json_for_any_patterns(tmp_path, patterns, keys):
+    source, target = str(tmp_path / "gen.jsonl"), str(tmp_path / "gen.idx")
+    _write_source(source, [[p, f"https://{i}.test/terms"] for i, p in enumerate(patterns)])
+    compile_database(source, target)
+
+    json_db, compiled_db = JsonDatabase(source), CompiledDatabase(target)
+    for key in keys:
+        assert list(compiled_db.matches(key)) == list(json_db.matches(key)), key
+
+
+def test_compiled_detects_same_size_edit(source, tmp_path):
+    target = str(tmp_path / "tos.idx")
+    compile_database(source, target)
+    assert CompiledDatabase(target).is_compiled_from(source)
+
+    # Same length but different content and modification time.
+    _write_source(source, ENTRIES[:-1] + [["example.com", "https://example.com/duplicatf"]])
+    os.utime(source, ns=(0, 0))
+    assert not CompiledDatabase(target).is_compiled_from(source)
+
+
+def test_invalid_database_is_rejected(tmp_path):
+    target = str(tmp_path / "tos.idx")
+    with open(target, 'wb') as f:
+        f.write(b"WOTOSDB2" + bytes(64))
+    with pytest.raises(InvalidDatabase):
+        CompiledDatabase(target)
+
+
+def test_load_database_recompiles_stale_index(source, tmp_path):
+    target = str(tmp_path / "tos.idx")
+    with open(target, 'wb') as f:
+        f.write(b"garbage")
+
+    database = load_database(source)
+    assert isinstance(database, CompiledDatabase)
+    assert [e.url for e in database.matches("example.com")] == [e.url for e in JsonDatabase(source).matches("example.com")]
+
+
+def test_load_database_hashes_touched_source_once(source, tmp_path, monkeypatch):
+    compile_database(source, str(tmp_path / "tos.idx"))
+    os.utime(source, ns=(0, 10**18))
+
+    hashed = []
+    digest = weboptout.database._source_digest
+    monkeypatch.setattr(weboptout.database, "_source_digest", lambda f: hashed.append(f) or digest(f))
+
+    for _ in range(3):
+        database = load_database(source)
+        assert isinstance(database, CompiledDatabase) and database.source_mtime == 10**18
+    assert len(hashed) == 1
+
+
+def _first_match(entries, host):
+    database = JsonDatabase()
+    database.entries = entries
+    return next((e.url for e in database.matches(host)), None)
+
+
+def test_generalize_hosts_clusters_labels():
+    hosts = {f"cdn{i}.example.com": "https://example.com/terms" for i in range(5)}
+    hosts["www.other.com"] = "https://other.com/terms"
+
+    entries = generalize_hosts(hosts)
+    assert ("cdn*.example.com", "https://example.com/terms") in entries
+    assert all(_first_match(entries, host) == url for host, url in hosts.items())
+
+
+_subdomains = st.lists(st.sampled_from(["www", "cdn1", "cdn2", "img", "a", "b"]), max_size=2)
+_domains = st.sampled_from(["example.com", "other.com", "site.co.uk", "shop.example.com"])
+
+
+@settings(max_examples=200)
+@given(hosts=st.dictionaries(st.tuples(_subdomains, _domains).map(lambda t: ".".join(t[0] + [t[1]])), st.sampled_from("abc"), max_size=20))
+def test_generalize_hosts_first_match_is_correct(hosts):
+    hosts = {host: f"https://{url}.test/terms" for host, url in hosts.items()}
+    entries = generalize_hosts(hosts)
+    for host, url in hosts.items():
+        assert _first_match(entries, host) == url, host
+
+
+def test_build_database_loads_as_generalized(tmp_path):
+    target = str(tmp_path / "tos.jsonl")
+    results = [("cdn1.example.com", "https://example.com/terms"), ("cdn2.example.com", "https://example.com/terms")]
+    assert build_database(results, target, "## Copyright") == 1
+    assert [e.pattern for e in JsonDatabase(target).entries] == ["cdn*.example.com"]
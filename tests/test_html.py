@@ -0,0 +1,52 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+from hypothesis import given, settings, strategies as st
+
+from weboptout.config import RE_TDM_CONCEPTS, RE_NFP_CONCEPTS, RE_LEGAL_WORDS
+from weboptout.html import classify_texts, fingerprint_paragraphs, _find_matching_paragraphs
+
+
+# Words from the patterns, characters that fold differently, and separators, so
+# generated texts often match, including over line breaks.
+WORDS = [
+    "scraping", "Data-Mining", "data mining", "crawler", "ROBOT", "spider", "non-commercial", "use", "purpose",
+    "commercial use of the site is strictly prohibited", "reserve", "Section", "liable", "consent", "privacy",
+    "the", "any", "is", "forbidden", "SCRAPİNG", "ſpider", "İ", "ı", "ß", ".", ";", "(", ")", ",",
+]
+SEPARATORS = [" ", " ", " ", "\n", "\t", "  "]
+
+_texts = st.lists(st.tuples(st.sampled_from(WORDS), st.sampled_from(SEPARATORS)), max_size=40).map(
+    lambda parts: "".join(w + s for w, s in parts)
+)
+
+
+def _classify_one(text: str) -> tuple:
+    return (
+        _find_matching_paragraphs(RE_TDM_CONCEPTS, text),
+        _find_matching_paragraphs(RE_NFP_CONCEPTS, text),
+        len(RE_LEGAL_WORDS.findall(text)),
+    )
+
+
+@settings(max_examples=300, deadline=None)
+@given(texts=st.lists(st.one_of(_texts, st.text(max_size=40)), max_size=6))
+def test_classify_texts_equals_each_text(texts):
+    assert [tuple(c) for c in classify_texts(texts)] == [_classify_one(t) for t in texts]
+
+
+def test_classify_texts_finds_reservations():
+    tdm, nfp, plain = classify_texts([
+        "You may not use any robot or scraper.\nSee section 2.",
+        "Non-commercial use only.",
+        "Welcome to our website.",
+    ])
+    assert tdm.tdm and not tdm.nfp
+    assert nfp.nfp and not nfp.tdm
+    assert not plain.tdm and not plain.nfp and plain.legal_words == 0
+
+
+def test_fingerprint_ignores_markup():
+    first = "<html><body><p>Terms of use.</p><script>var a = 1;</script></body></html>"
+    second = "<html><head><style>p {}</style></head><body><p>Terms of use.</p></body></html>"
+    assert fingerprint_paragraphs(first) == fingerprint_paragraphs(second)
+    assert fingerprint_paragraphs(first) != fingerprint_paragraphs(first.replace("use", "service"))
@@ -0,0 +1,45 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import socket
+
+import aiohttp
+
+from weboptout.config import FAILURE_RETRY_DELAY, FAILURE_RETRY_MAX_DELAY
+from weboptout.http import FetchFailure, _count_failures, _is_expired_failure, _classify_connection_error
+
+
+def test_failure_delay_doubles_and_is_capped():
+    delays = [FetchFailure("timeout", 0.0, attempts).expires_at for attempts in range(1, 4)]
+    assert delays == [FAILURE_RETRY_DELAY["timeout"] * 2 ** i for i in range(3)]
+    assert FetchFailure("dns", 0.0, attempts=20).expires_at == FAILURE_RETRY_MAX_DELAY
+
+
+def test_expired_failures():
+    assert not _is_expired_failure(("https://example.com", {}, "<html></html>"))
+    assert _is_expired_failure(("https://example.com", FetchFailure("timeout", 0.0), None))
+    assert not _is_expired_failure(("https://example.com", FetchFailure("timeout", 1e12), None))
+    # Failures cached before they were recorded explicitly.
+    assert _is_expired_failure(("https://example.com", {}, None))
+
+
+def test_count_failures_merges_attempts():
+    previous = ("https://example.com", FetchFailure("dns", 0.0, attempts=3), None)
+    result = _count_failures(previous, ("https://example.com", FetchFailure("dns", 10.0), None))
+    assert result[1].attempts == 4 and result[1].failed_at == 10.0
+
+    # A page fetched after failures is stored as is.
+    page = ("https://example.com", {}, "<html></html>")
+    assert _count_failures(previous, page) is page
+
+
+def test_classify_connection_error():
+    def _error(os_error, cls=aiohttp.ClientConnectorError):
+        return cls(None, os_error)
+
+    assert _classify_connection_error(_error(socket.gaierror(socket.EAI_NONAME, "Name or service not known"))) == "dns"
+    assert _classify_connection_error(_error(socket.gaierror(socket.EAI_AGAIN, "Temporary failure"))) == "connection"
+    assert _classify_connection_error(_error(ConnectionRefusedError(111, "Connection refused"))) == "connection"
+    assert _classify_connection_error(aiohttp.ServerDisconnectedError()) == "connection"
+    # The resolver using aiodns raises plain errors without a number.
+    if hasattr(aiohttp, "ClientConnectorDNSError"):
+        assert _classify_connection_error(_error(OSError(None, "Domain name not found"), aiohttp.ClientConnectorDNSError)) == "dns"
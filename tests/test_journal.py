@@ -0,0 +1,91 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import os
+import pickle
+import multiprocessing
+
+from weboptout.journal import Journal
+
+
+def _write_many(filename, worker, count):
+    journal = Journal(filename, min_compact_size=512)
+    for i in range(count):
+        journal.put((worker, i), {"worker": worker, "index": i})
+        if i % 10 == 9:
+            journal.delete((worker, i - 5))
+    journal.close()
+
+
+def _expected(workers, count):
+    return {
+        (w, i): {"worker": w, "index": i}
+        for w in range(workers) for i in range(count)
+        if not (i % 10 == 4 and i + 5 < count)
+    }
+
+
+def test_put_delete_and_reload(tmp_path):
+    filename = str(tmp_path / "state.pkl")
+    journal = Journal(filename)
+    journal.put("a", 1)
+    journal.put("b", 2)
+    journal.put("a", 3)
+    journal.delete("b")
+    journal.close()
+
+    assert Journal(filename).load() == {"a": 3}
+
+
+def test_compaction_keeps_state_and_times(tmp_path):
+    filename = str(tmp_path / "state.pkl")
+    journal = Journal(filename, min_compact_size=256)
+    for i in range(100):
+        journal.put(i, "x" * 10)
+    journal.put(5, "y", changed=1234.0)
+    journal.close()
+
+    state, times = Journal(filename).read()
+    assert state == {**{i: "x" * 10 for i in range(100)}, 5: "y"}
+    assert times[5] == 1234.0
+
+    Journal(filename).compact()
+    assert Journal(filename).read() == (state, times)
+
+
+def test_torn_records_are_skipped(tmp_path):
+    filename = str(tmp_path / "state.pkl")
+    journal = Journal(filename)
+    journal.put("a", 1)
+    journal.close()
+
+    # A partial write from a process that died, then more records after it.
+    with open(journal.journal, 'ab') as f:
+        f.write(b"WOJ1\xff\xff")
+    journal = Journal(filename)
+    journal.put("b", 2)
+    journal.close()
+
+    assert Journal(filename).load() == {"a": 1, "b": 2}
+
+
+def test_older_snapshots_and_records_load(tmp_path):
+    filename = str(tmp_path / "state.pkl")
+    with open(filename, 'wb') as f:
+        pickle.dump({"a": 1}, f)
+
+    state, times = Journal(filename).read()
+    assert state == {"a": 1} and times == {}
+
+
+def test_concurrent_writers_with_compaction(tmp_path):
+    filename, workers, count = str(tmp_path / "state.pkl"), 4, 200
+    processes = [multiprocessing.Process(target=_write_many, args=(filename, w, count)) for w in range(workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+        assert p.exitcode == 0
+
+    # The journal grew past its minimum size, so it was compacted while writing.
+    assert os.path.isfile(filename)
+    assert Journal(filename).load() == _expected(workers, count)
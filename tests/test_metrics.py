@@ -0,0 +1,15 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+from weboptout.metrics import MetricsRegistry
+
+
+def test_counter_values():
+    registry = MetricsRegistry()
+    assert registry.counter("weboptout_bulk_resumed_total") == 0
+
+    registry.increment("weboptout_bulk_resumed_total")
+    registry.increment("weboptout_cache_total", 2, tier="www", result="hit")
+    assert registry.counter("weboptout_bulk_resumed_total") == 1
+    assert registry.counter("weboptout_cache_total", tier="www", result="hit") == 2
+    assert registry.counter("weboptout_cache_total", tier="www", result="miss") == 0
+    assert 'weboptout_cache_total{tier="www",result="hit"} 2' in registry.to_prometheus()
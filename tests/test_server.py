@@ -0,0 +1,107 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import json
+import asyncio
+import collections
+
+import pytest
+from aiohttp.test_utils import TestServer, TestClient
+
+import weboptout.server
+from weboptout import rsv
+from weboptout.server import ReservationService, create_app
+
+
+class FakeChecks:
+    """
+    Replaces the checks of the service with results from a table, counting the
+    calls, where each check takes a little time so requests overlap.
+    """
+
+    def __init__(self, results: dict):
+        self.results, self.calls = results, collections.Counter()
+
+    async def __call__(self, domain, **options):
+        self.calls[domain] += 1
+        await asyncio.sleep(0.02)
+        if (status := self.results.get(domain)) is None:
+            raise RuntimeError(f"Unexpected failure for {domain}.")
+        return status(url=f"https://{domain}/terms")
+
+
+@pytest.fixture
+def checks(monkeypatch):
+    fake = FakeChecks({"yes.com": rsv.YES, "www.yes.com": rsv.YES, "maybe.com": rsv.MAYBE, "error.com": rsv.ERROR})
+    monkeypatch.setattr(weboptout.server, "check_domain_reservation", fake)
+    return fake
+
+
+async def _with_service(fn, **options):
+    service = ReservationService(**options)
+    await service.start()
+    try:
+        return await fn(service)
+    finally:
+        await service.close()
+
+
+def test_concurrent_requests_are_coalesced(checks):
+    async def _run(service):
+        # Subdomains are different keys, as their terms can differ.
+        sources = ["yes.com", "YES.com.", "https://yes.com/image.jpg", "http://www.yes.com/"]
+        return await asyncio.gather(*[service.check(s) for s in sources])
+
+    results = asyncio.run(_with_service(_run))
+    assert [rsv.get_name(r) for r in results] == ["YES"] * 4
+    assert checks.calls == {"yes.com": 1, "www.yes.com": 1}
+
+
+def test_results_expire_and_errors_are_not_kept(checks):
+    async def _run(service):
+        for _ in range(2):
+            await service.check("yes.com")
+            await service.check("error.com")
+        await asyncio.sleep(0.2)
+        await service.check("yes.com")
+
+    asyncio.run(_with_service(_run, ttl=0.1))
+    assert checks.calls == {"yes.com": 2, "error.com": 2}
+
+
+def test_capacity_evicts_least_recent(checks):
+    async def _run(service):
+        for source in ("yes.com", "maybe.com", "yes.com"):
+            await service.check(source)
+        return list(service.results)
+
+    assert asyncio.run(_with_service(_run, capacity=1)) == ["yes.com"]
+    assert checks.calls == {"yes.com": 2, "maybe.com": 1}
+
+
+async def _request(method, path, **kwargs):
+    async with TestClient(TestServer(create_app(jobs=4))) as client:
+        response = await client.request(method, path, **kwargs)
+        return response.status, await response.text()
+
+
+def test_check_endpoint(checks):
+    status, body = asyncio.run(_request("GET", "/check?url=https://maybe.com/image.jpg"))
+    assert status == 200
+    assert json.loads(body)["status"] == "MAYBE"
+
+    status, _ = asyncio.run(_request("GET", "/check"))
+    assert status == 400
+
+
+def test_batch_endpoint_reports_errors_per_source(checks):
+    status, body = asyncio.run(_request("POST", "/batch", data=json.dumps(["yes.com", "broken.com", "maybe.com"])))
+    assert status == 200
+    results = {r["source"]: r["status"] for r in map(json.loads, body.splitlines())}
+    assert results == {"yes.com": "YES", "broken.com": "ERROR", "maybe.com": "MAYBE"}
+
+
+@pytest.mark.parametrize("data", ["[\"yes.com\",", "[\"yes.com\", 42]"])
+def test_batch_endpoint_rejects_invalid_input(checks, data):
+    status, _ = asyncio.run(_request("POST", "/batch", data=data))
+    assert status == 400
+    assert checks.calls == {}
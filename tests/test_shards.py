@@ -0,0 +1,75 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import io
+import os
+import json
+import time
+import pickle
+
+from weboptout.http import FetchFailure
+from weboptout.journal import Journal
+from weboptout.shards import registrable_domain, shard_of, select_shard, merge_results, merge_caches
+
+
+def test_registrable_domain():
+    assert registrable_domain("www.cdn.example.com") == "example.com"
+    assert registrable_domain("shop.example.co.uk.") == "example.co.uk"
+    assert registrable_domain("example.io") == "example.io"
+
+
+def test_shard_of_keeps_related_hosts_together():
+    for count in (1, 3, 16):
+        shard = shard_of("example.co.uk", count)
+        assert 0 <= shard < count
+        assert shard_of("www.example.co.uk", count) == shard
+        assert shard_of("https://cdn.example.co.uk:443/image.jpg", count) == shard
+
+    # Stable across processes and versions, as shards run on separate machines.
+    assert [shard_of(f"site-{i}.com", 8) for i in range(8)] == [2, 1, 3, 3, 7, 7, 4, 2]
+
+
+def test_select_shard_partitions_sources():
+    sources = [f"site-{i}.com" for i in range(100)] + ["# comment", ""]
+    shards = [list(select_shard(sources, i, 4)) for i in range(4)]
+    assert sorted(s for shard in shards for s in shard) == sorted(sources[:100])
+
+
+def test_merge_results_counts_statuses(tmp_path):
+    files = []
+    for i, statuses in enumerate([["YES", "MAYBE"], [], ["YES", "ERROR"]]):
+        files.append(str(tmp_path / f"shard-{i}.jsonl"))
+        with open(files[-1], 'w') as f:
+            f.writelines(json.dumps({"source": f"{i}-{j}.com", "status": s}) + "\n" for j, s in enumerate(statuses))
+
+    output = io.StringIO()
+    assert merge_results(files, output) == {"YES": 2, "MAYBE": 1, "ERROR": 1}
+    assert [json.loads(line)["source"] for line in output.getvalue().splitlines()] == ["0-0.com", "0-1.com", "2-0.com", "2-1.com"]
+
+
+def _write_page(directory, name, result, mtime):
+    os.makedirs(os.path.join(directory, "www"), exist_ok=True)
+    filename = os.path.join(directory, "www", name)
+    with open(filename, 'wb') as f:
+        pickle.dump(result, f)
+    os.utime(filename, (mtime, mtime))
+
+
+def test_merge_caches_keeps_pages_over_newer_failures(tmp_path):
+    first, second, target = str(tmp_path / "first"), str(tmp_path / "second"), str(tmp_path / "target")
+    now = time.time()
+    _write_page(first, "page.pkl", ("https://example.com", {}, "<html>Terms</html>"), now - 3600)
+    _write_page(second, "page.pkl", ("https://example.com", FetchFailure("timeout", now), None), now)
+
+    merge_caches([first, second], target)
+    with open(os.path.join(target, "www", "page.pkl"), 'rb') as f:
+        assert pickle.load(f)[2] == "<html>Terms</html>"
+
+
+def test_merge_caches_merges_journal_entries(tmp_path):
+    first, second, target = str(tmp_path / "first"), str(tmp_path / "second"), str(tmp_path / "target")
+    Journal(os.path.join(first, "tos.pkl")).put("a.com", 1)
+    Journal(os.path.join(second, "tos.pkl")).put("b.com", 2)
+    Journal(os.path.join(second, "tos.pkl")).compact()
+
+    assert merge_caches([first, second], target) == 2
+    assert Journal(os.path.join(target, "tos.pkl")).load() == {"a.com": 1, "b.com": 2}
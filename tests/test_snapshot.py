@@ -0,0 +1,80 @@
+## Copyright © 2023, Alex J. Champandard.  Licensed under MIT; see LICENSE! ⚘
+
+import os
+import time
+import pickle
+
+from weboptout.http import FetchFailure
+from weboptout.journal import Journal
+from weboptout.snapshot import export_cache, import_cache
+
+
+def _write_page(directory, name, result, mtime=None):
+    os.makedirs(os.path.join(directory, "www"), exist_ok=True)
+    filename = os.path.join(directory, "www", name)
+    with open(filename, 'wb') as f:
+        pickle.dump(result, f)
+    if mtime is not None:
+        os.utime(filename, (mtime, mtime))
+    return filename
+
+
+def _read_page(directory, name):
+    with open(os.path.join(directory, "www", name), 'rb') as f:
+        return pickle.load(f)
+
+
+def _make_cache(directory):
+    _write_page(directory, "page.pkl", ("https://example.com", {}, "<html>Terms</html>"))
+    _write_page(directory, "failure.pkl", ("https://dead.com", FetchFailure("dns", time.time()), None))
+    # Journals in directories that don't exist yet where they're imported.
+    journal = Journal(os.path.join(directory, "runs", "recrawl.pkl"))
+    journal.put("example.com", ("https://example.com/terms", "digest", "YES", time.time()))
+    journal.put("other.org", ("https://other.org/terms", "digest", "MAYBE", time.time()))
+    journal.close()
+
+
+def test_import_into_empty_directory(tmp_path):
+    source, target = str(tmp_path / "source"), str(tmp_path / "fresh")
+    _make_cache(source)
+
+    assert export_cache(str(tmp_path / "cache.tar.gz"), source) == {"pages": 1, "failures": 1, "results": 2}
+    counts = import_cache(str(tmp_path / "cache.tar.gz"), target)
+    assert counts["pages imported"] == 2 and counts["results imported"] == 2
+
+    assert _read_page(target, "page.pkl") == _read_page(source, "page.pkl")
+    assert Journal(os.path.join(target, "runs", "recrawl.pkl")).load() == Journal(os.path.join(source, "runs", "recrawl.pkl")).load()
+
+    # Importing again changes nothing.
+    counts = import_cache(str(tmp_path / "cache.tar.gz"), target)
+    assert counts["pages skipped"] == 2 and counts["results skipped"] == 2
+
+
+def test_export_filters_domains(tmp_path):
+    source, target = str(tmp_path / "source"), str(tmp_path / "fresh")
+    _make_cache(source)
+
+    export_cache(str(tmp_path / "cache.tar.gz"), source, domains={"example.com"})
+    import_cache(str(tmp_path / "cache.tar.gz"), target)
+    assert os.listdir(os.path.join(target, "www")) == ["page.pkl"]
+    assert list(Journal(os.path.join(target, "runs", "recrawl.pkl")).load()) == ["example.com"]
+
+
+def test_failures_never_replace_pages(tmp_path):
+    source, target = str(tmp_path / "source"), str(tmp_path / "target")
+    _write_page(source, "page.pkl", ("https://example.com", FetchFailure("timeout", time.time()), None))
+    _write_page(target, "page.pkl", ("https://example.com", {}, "<html>Terms</html>"), mtime=time.time() - 3600)
+
+    export_cache(str(tmp_path / "cache.tar.gz"), source)
+    assert import_cache(str(tmp_path / "cache.tar.gz"), target)["pages skipped"] == 1
+    assert _read_page(target, "page.pkl")[2] == "<html>Terms</html>"
+
+
+def test_journal_entries_newer_locally_are_kept(tmp_path):
+    source, target = str(tmp_path / "source"), str(tmp_path / "target")
+    Journal(os.path.join(source, "recrawl.pkl")).put("example.com", "old", changed=time.time() - 3600)
+    Journal(os.path.join(target, "recrawl.pkl")).put("example.com", "new")
+
+    export_cache(str(tmp_path / "cache.tar.gz"), source)
+    assert import_cache(str(tmp_path / "cache.tar.gz"), target)["results skipped"] == 1
+    assert Journal(os.path.join(target, "recrawl.pkl")).load() == {"example.com": "new"}